@@ -1,10 +1,14 @@
 from adapt.intent import IntentBuilder
 from mycroft.skills.core import FallbackSkill
-from mycroft.util.format import nice_number
+from mycroft.util.format import nice_number, nice_duration, join_list
 from mycroft import MycroftSkill, intent_handler
+from mycroft.messagebus.message import Message
 
+from datetime import datetime, timedelta
+from functools import wraps
 from os.path import dirname, join
 from sys import exc_info
+from threading import Lock, Thread
 
 from requests.exceptions import (
     RequestException,
@@ -16,6 +20,12 @@ from requests.exceptions import (
 from requests.packages.urllib3.exceptions import MaxRetryError
 
 from .ha_client import HomeAssistantClient
+from .state_cache import DEFAULT_BUDGET
+from .entity_vocab import EntityVocabulary, ENTITY_NAME
+from .fallback_gate import FallbackGate
+from .command_queue import CommandQueue, CommandQueued, QUEUE_TTL
+from .followup import FollowUpContext
+from .dispatch import DEFAULT_RATE, Ticket
 
 
 __author__ = 'robconnolly, btotharye, nielstron'
@@ -23,6 +33,22 @@ __author__ = 'robconnolly, btotharye, nielstron'
 # Timeout time for HA requests
 TIMEOUT = 10
 
+# Settings a client is built from, changing one requires a new client
+CLIENT_SETTINGS = ('host', 'token', 'portnum', 'ssl', 'verify',
+                   'alternative_urls', 'proxy')
+
+# Seconds between attempts to send queued commands to HA
+QUEUE_RETRY = 15
+
+# States of sensors that have no value to read out
+NO_VALUE_STATES = ('unavailable', 'unknown')
+
+# Percent of brightness a 'bit brighter' or 'bit dimmer' changes
+BRIGHTNESS_STEP = 10
+
+# Seconds the first calls of a paced command may take before confirming
+TICKET_CHECK = 0.5
+
 
 class HomeAssistantSkill(FallbackSkill):
 
@@ -31,51 +57,144 @@ class HomeAssistantSkill(FallbackSkill):
         super().__init__(name="HomeAssistantSkill")
         self.ha = None
         self.enable_fallback = False
+        self.entity_vocab = None
+        self._entity_registered = False
+        self._adapt_entities = set()
+        self._setup_lock = Lock()
+        self._vocab_lock = Lock()
+        self.fallback_gate = FallbackGate()
+        self._client_settings = None
+        self._conversation_available = False
+        self.command_queue = None
+        self._replay_scheduled = False
+        # HandlerProfiler while profiling is enabled
+        self.profiler = None
+        # unit of measurement -> pronounceable unit
+        self._unit_names = {}
+        # what 'it' and 'them' refer to, per device session
+        self.follow_up = FollowUpContext()
 
     def _setup(self, force=False):
-        if self.settings is not None and (force or self.ha is None):
-            ip = self.settings.get('host')
-            token = self.settings.get('token')
-
-            # Check if user filled IP, port and Token in configuration
-            if not ip:
-                self.speak_dialog('homeassistant.error.setup', data={
-                              "field": "I.P."})
-                return
+        if self.settings is None or not (force or self.ha is None):
+            return
+        # handlers run concurrently, only one of them builds a client
+        with self._setup_lock:
+            if force or self.ha is None:
+                self._create_client()
+
+    def _create_client(self):
+        client_settings = self._get_client_settings()
+        ip = self.settings.get('host')
+        token = self.settings.get('token')
+        proxy = self.settings.get('proxy')
+
+        # Check if user filled IP, port and Token in configuration
+        if not ip and not proxy:
+            self.speak_dialog('homeassistant.error.setup', data={
+                          "field": "I.P."})
+            return
 
-            if not token:
-                self.speak_dialog('homeassistant.error.setup', data={
-                              "field": "token"})
-                return
+        if not token:
+            self.speak_dialog('homeassistant.error.setup', data={
+                          "field": "token"})
+            return
 
-            portnumber = self.settings.get('portnum')
-            try:
-                portnumber = int(portnumber)
-            except TypeError:
-                portnumber = 8123
-            except ValueError:
-                # String might be some rubbish (like '')
-                self.speak_dialog('homeassistant.error.setup', data={
-                              "field": "port"})
-                return
+        portnumber = self.settings.get('portnum')
+        try:
+            portnumber = int(portnumber)
+        except TypeError:
+            portnumber = 8123
+        except ValueError:
+            # String might be some rubbish (like '')
+            self.speak_dialog('homeassistant.error.setup', data={
+                          "field": "port"})
+            return
 
-            self.ha = HomeAssistantClient(
+        if proxy:
+            # a local proxy daemon keeps the connection to HA
+            from .ha_proxy import HomeAssistantProxyClient
+            ha = HomeAssistantProxyClient(proxy, token, self._cache_budget(),
+                                          self.lang)
+        else:
+            ha = HomeAssistantClient(
                 ip,
                 token,
                 portnumber,
                 self.settings.get('ssl'),
-                self.settings.get('verify')
+                self.settings.get('verify'),
+                self._cache_budget(),
+                self._alternative_urls(),
+                self.lang
             )
-            if self.ha.connected():
-                # Check if conversation component is loaded at HA-server
-                # and activate fallback accordingly (ha-server/api/components)
-                # TODO: enable other tools like dialogflow
-                conversation_activated = self.ha.find_component(
-                    'conversation'
-                )
-                if conversation_activated:
-                    self.enable_fallback = \
-                        self.settings.get('enable_fallback')
+        ha.names_listener = self._update_entity_vocab
+        ha.areas_listener = self.fallback_gate.update_areas
+        conversation_available = False
+        # warm up the state mirror before the new client is used
+        connected = ha.connected()
+        if connected:
+            # Check if conversation component is loaded at HA-server
+            # and activate fallback accordingly (ha-server/api/components)
+            # TODO: enable other tools like dialogflow
+            conversation_available = ha.find_component('conversation')
+            # the area names let "... in the garage" pass the fallback gate
+            ha.membership()
+
+        # handlers in flight keep using the previous client, which is
+        # left working, but without its worker threads
+        previous = self.ha
+        self.ha = ha
+        if previous is not None:
+            previous.close()
+        self._client_settings = client_settings
+        self._conversation_available = conversation_available
+        self._apply_settings()
+        if connected:
+            # commands queued before a restart of the skill
+            self._replay_commands()
+
+    def _get_client_settings(self):
+        return tuple(self.settings.get(key) for key in CLIENT_SETTINGS)
+
+    def _apply_settings(self):
+        """Apply the settings an existing client can adopt in place"""
+        self.ha.cache.resize(self._cache_budget())
+        if self.command_queue is not None:
+            self.command_queue.ttl = self._queue_ttl()
+        self.ha.queue = (self.command_queue
+                         if self.settings.get('offline_queue') else None)
+        self.ha.pace(self._dispatch_rate(), self._dispatch_failed)
+        self.enable_fallback = bool(self._conversation_available and
+                                    self.settings.get('enable_fallback'))
+
+    def _cache_budget(self):
+        """Memory budget of the state cache in bytes"""
+        try:
+            return int(self.settings.get('cache_budget')) * 1024
+        except (TypeError, ValueError):
+            return DEFAULT_BUDGET
+
+    def _queue_ttl(self):
+        """Seconds a command waits for HA while it is unreachable"""
+        try:
+            return int(self.settings.get('queue_ttl')) * 60
+        except (TypeError, ValueError):
+            return QUEUE_TTL
+
+    def _dispatch_rate(self):
+        """Calls per second for commands to many entities, None if off"""
+        if not self.settings.get('paced_dispatch'):
+            return None
+        try:
+            rate = float(self.settings.get('dispatch_rate'))
+        except (TypeError, ValueError):
+            return DEFAULT_RATE
+        return rate if rate > 0 else DEFAULT_RATE
+
+    def _alternative_urls(self):
+        """Further base urls of the HA server, e.g. the external one"""
+        urls = self.settings.get('alternative_urls') or ''
+        return [url.strip().rstrip('/') for url in urls.split(',')
+                if url.strip()]
 
     def _force_setup(self):
         self.log.debug('Creating a new HomeAssistant-Client')
@@ -85,6 +204,17 @@ class HomeAssistantSkill(FallbackSkill):
         self.language = self.config_core.get('lang')
         self.load_vocab_files(join(dirname(__file__), 'vocab', self.lang))
         self.load_regex_files(join(dirname(__file__), 'regex', self.lang))
+        self.entity_vocab = EntityVocabulary(
+            join(self.file_system.path, 'vocab'), self.lang)
+        self.command_queue = CommandQueue(
+            join(self.file_system.path, 'command_queue.jsonl'))
+        try:
+            self.fallback_gate = FallbackGate(
+                self.translate_list('homeassistant.command.keywords') or [])
+        except FileNotFoundError:
+            # no keywords in this language, only entity names count
+            pass
+        self._setup_profiler()
         self.__build_automation_intent()
         self.__build_tracker_intent()
 
@@ -92,12 +222,80 @@ class HomeAssistantSkill(FallbackSkill):
         self.register_fallback(self.handle_fallback, 2)
         # Check and then monitor for credential changes
         self.settings_change_callback = self.on_websettings_changed
-        self._setup()
+        # connecting to HA must not hold up loading the skill, handlers
+        # wait for the setup if they come first
+        Thread(target=self._setup, daemon=True).start()
 
     def on_websettings_changed(self):
-        # Force a setting refresh after the websettings changed
-        # Otherwise new settings will not be regarded
-        self._force_setup()
+        self._setup_profiler()
+        # Only a changed connection needs a new client, anything else is
+        # applied to the running one and keeps its connections and caches
+        if (self.ha is None or
+                self._get_client_settings() != self._client_settings):
+            self._force_setup()
+        else:
+            self.log.debug('Applying settings to the HomeAssistant-Client')
+            with self._setup_lock:
+                self._apply_settings()
+
+    def _setup_profiler(self):
+        """Start or stop profiling intent handlers as configured"""
+        try:
+            fraction = float(self.settings.get('profile_percent')) / 100
+        except (TypeError, ValueError):
+            fraction = 0
+        if not self.settings.get('profiling') or fraction <= 0:
+            self.profiler = None
+        elif self.profiler is None:
+            # cProfile is only loaded if profiling is enabled
+            from .profiler import HandlerProfiler
+            self.profiler = HandlerProfiler(
+                join(self.file_system.path, 'profiles'), fraction)
+        else:
+            self.profiler.fraction = fraction
+
+    def _profiled(self, handler):
+        """Wrap an intent handler to be profiled while enabled"""
+        if getattr(handler, 'profiled', False):
+            return handler
+
+        @wraps(handler)
+        def profiled(message):
+            profiler = self.profiler
+            if profiler is None:
+                return handler(message)
+            return profiler.run(handler.__name__, handler, message)
+        profiled.profiled = True
+        return profiled
+
+    def register_intent(self, intent_parser, handler):
+        super().register_intent(intent_parser, self._profiled(handler))
+
+    def register_intent_file(self, intent_file, handler):
+        super().register_intent_file(intent_file, self._profiled(handler))
+
+    def _update_entity_vocab(self, names):
+        """Register the HA friendly names with the intent parsers
+
+        Padatious gets a generated .entity file, so {entity} is pinned to
+        a known name at parse time; Adapt gets the names as 'Entity'
+        vocabulary. Called by the client whenever the names change.
+        """
+        self.fallback_gate.update(names)
+        if self.entity_vocab is None:
+            return
+        with self._vocab_lock:
+            changed = self.entity_vocab.update(names)
+            if changed or not self._entity_registered:
+                self.bus.emit(Message('padatious:register_entity', {
+                    'file_name': self.entity_vocab.path,
+                    'name': '{}:{}'.format(self.skill_id, ENTITY_NAME)
+                }))
+                self._entity_registered = True
+            # Adapt vocabulary can not be removed, only register new names
+            for name in self.entity_vocab.names - self._adapt_entities:
+                self.register_vocabulary(name, 'Entity')
+            self._adapt_entities |= self.entity_vocab.names
 
     def __build_automation_intent(self):
         intent = IntentBuilder("AutomationIntent").require(
@@ -107,7 +305,7 @@ class HomeAssistantSkill(FallbackSkill):
     def __build_tracker_intent(self):
         intent = IntentBuilder("TrackerIntent").require(
             "DeviceTrackerKeyword").require("Entity").build()
-        # TODO - Identity location, proximity
+        # proximity is handled by the tracker.*.intent handlers
         self.register_intent(intent, self.handle_tracker_intent)
 
     # Try to find an entity on the HAServer
@@ -146,6 +344,9 @@ class HomeAssistantSkill(FallbackSkill):
     def _handle_client_exception(self, callback, *args, **kwargs):
         try:
             return callback(*args, **kwargs)
+        except CommandQueued:
+            self.speak_dialog('homeassistant.queued')
+            self._schedule_replay()
         except Timeout:
             self.speak_dialog('homeassistant.error.offline')
         except (InvalidURL, URLRequired, MaxRetryError) as e:
@@ -172,6 +373,56 @@ class HomeAssistantSkill(FallbackSkill):
 
         return False
 
+    def _execute_service(self, domain, service, data):
+        """Call a HA service, False if it failed or was queued"""
+        result = self._handle_client_exception(self.ha.execute_service,
+                                               domain, service, data)
+        if isinstance(result, Ticket):
+            # a paced command is still being sent, but if HA refuses the
+            # first calls the user hears why instead of a confirmation
+            result = self._handle_client_exception(self._check_ticket,
+                                                   result)
+        return result
+
+    def _check_ticket(self, ticket):
+        ticket.wait(TICKET_CHECK)
+        if ticket.errors:
+            raise ticket.errors[0]
+        return ticket
+
+    def _dispatch_failed(self, domain, service, data, error):
+        """Paced calls fail after the handler returned, log them"""
+        if isinstance(error, CommandQueued):
+            self.log.info('Queued {}.{} for {} until HA is back'.format(
+                domain, service, data.get('entity_id')))
+            self._schedule_replay()
+        else:
+            self.log.warning('Paced call {}.{} for {} failed: {}'.format(
+                domain, service, data.get('entity_id'), error))
+
+    def _schedule_replay(self):
+        if not self._replay_scheduled:
+            self._replay_scheduled = True
+            self.schedule_repeating_event(self._replay_commands, None,
+                                          QUEUE_RETRY,
+                                          name='HomeAssistantReplay')
+
+    def _replay_commands(self, message=None):
+        """Send the commands queued while HA was unreachable"""
+        ha = self.ha
+        if ha is None:
+            return
+        try:
+            sent = ha.replay_queue()
+        except RequestException:
+            return
+        if sent:
+            self.log.info('Sent {} queued calls to HA'.format(sent))
+        if ha.queue is None or not len(ha.queue):
+            if self._replay_scheduled:
+                self.cancel_scheduled_event('HomeAssistantReplay')
+                self._replay_scheduled = False
+
     # Intent handlers
     @intent_handler('turn.on.intent')
     def handle_turn_on_intent(self, message):
@@ -262,7 +513,11 @@ class HomeAssistantSkill(FallbackSkill):
         color_parts = list(color.split())
 
         ha_data['color_name'] = message.data['color']
-        self.ha.execute_service("light", "turn_on", ha_data)
+        if not self._execute_service("light", "turn_on", ha_data):
+            return
+        self._remember(message, ha_data['entity_id'], ha_entity['dev_name'],
+                       'light' if ha_data['entity_id'] == 'all'
+                       else 'homeassistant')
 
         ha_data['dev_name'] = ha_entity['dev_name']
         self.speak_dialog('homeassistant.color.change', data=ha_data)
@@ -287,8 +542,11 @@ class HomeAssistantSkill(FallbackSkill):
                 ha_entity = {'dev_name': entity}
                 ha_data = {'entity_id': 'all'}
 
-                self.ha.execute_service(domain, "turn_%s" % action, ha_data)
-                self.speak_dialog('homeassistant.device.%s' % action, data=ha_entity)
+                if self._execute_service(domain, "turn_%s" % action,
+                                         ha_data):
+                    self._remember(message, 'all', entity, domain)
+                    self.speak_dialog('homeassistant.device.%s' % action,
+                                      data=ha_entity)
                 return
         # TODO: need to figure out, if this indeed throws a KeyError
         except KeyError:
@@ -319,15 +577,16 @@ class HomeAssistantSkill(FallbackSkill):
 
         ha_data = {'entity_id': ha_entity['id']}
 
-        # IDEA: set context for 'turn it off' again or similar
-        # self.set_context('Entity', ha_entity['dev_name'])
+        # 'turn it off again' refers to this entity
+        self._remember(message, ha_entity['id'], ha_entity['dev_name'])
         if ha_entity['state'] == action:
             self.log.debug("Entity in requested state")
             self.speak_dialog('homeassistant.device.already', data={
                 "dev_name": ha_entity['dev_name'], 'action': action})
         elif action == "toggle":
-            self.ha.execute_service("homeassistant", "toggle",
-                                    ha_data)
+            if not self._execute_service("homeassistant", "toggle",
+                                         ha_data):
+                return
             if(ha_entity['state'] == 'off'):
                 action = 'on'
             else:
@@ -335,10 +594,10 @@ class HomeAssistantSkill(FallbackSkill):
             self.speak_dialog('homeassistant.device.%s' % action,
                               data=ha_entity)
         elif action in ["on", "off"]:
-            self.speak_dialog('homeassistant.device.%s' % action,
-                              data=ha_entity)
-            self.ha.execute_service("homeassistant", "turn_%s" % action,
-                                    ha_data)
+            if self._execute_service("homeassistant", "turn_%s" % action,
+                                     ha_data):
+                self.speak_dialog('homeassistant.device.%s' % action,
+                                  data=ha_entity)
         else:
             self.speak_dialog('homeassistant.error.sorry')
             return
@@ -364,11 +623,12 @@ class HomeAssistantSkill(FallbackSkill):
 
         ha_data = {'entity_id': ha_entity['id']}
 
-        # IDEA: set context for 'turn it off again' or similar
-        # self.set_context('Entity', ha_entity['dev_name'])
+        # 'turn it off again' refers to this entity
+        self._remember(message, ha_entity['id'], ha_entity['dev_name'])
         # Set values for HA
         ha_data['brightness'] = brightness_value
-        self.ha.execute_service("light", "turn_on", ha_data)
+        if not self._execute_service("light", "turn_on", ha_data):
+            return
         # Set values for mycroft reply
         ha_data['dev_name'] = ha_entity['dev_name']
         ha_data['brightness'] = brightness_req
@@ -377,12 +637,77 @@ class HomeAssistantSkill(FallbackSkill):
 
         return
 
+    @intent_handler('followup.on.intent')
+    def handle_followup_on_intent(self, message):
+        self._handle_follow_up(message, 'turn_on')
+
+    @intent_handler('followup.off.intent')
+    def handle_followup_off_intent(self, message):
+        self._handle_follow_up(message, 'turn_off')
+
+    @intent_handler('followup.brighter.intent')
+    def handle_followup_brighter_intent(self, message):
+        self._handle_follow_up(message, 'turn_on', BRIGHTNESS_STEP)
+
+    @intent_handler('followup.dimmer.intent')
+    def handle_followup_dimmer_intent(self, message):
+        self._handle_follow_up(message, 'turn_on', -BRIGHTNESS_STEP)
+
+    def _handle_follow_up(self, message, service, step=None):
+        """Call service for the entity of the last command
+
+        The entity is neither looked up nor its state fetched; a
+        brightness change is sent as a relative step instead.
+        """
+        entity = self.follow_up.recall(self._session(message))
+        if entity is None:
+            self.speak_dialog('homeassistant.followup.unknown')
+            return
+        self._setup()
+        if self.ha is None:
+            self.speak_dialog('homeassistant.error.setup')
+            return
+        ha_data = {'entity_id': entity['id']}
+        if step is not None:
+            if not (entity['domain'] == 'light' or
+                    entity['id'].split(".")[0] in ('light', 'group')):
+                self.speak_dialog('homeassistant.brightness.cantdim.dimmable',
+                                  data=entity)
+                return
+            ha_data['brightness_step_pct'] = step
+        if not self._execute_service(entity['domain'], service, ha_data):
+            return
+        self._remember(message, entity['id'], entity['dev_name'],
+                       entity['domain'])
+        if step is None:
+            self.speak_dialog('homeassistant.device.%s' % service[5:],
+                              data=entity)
+        elif step > 0:
+            self.speak_dialog('homeassistant.followup.brighter', data=entity)
+        else:
+            self.speak_dialog('homeassistant.followup.dimmer', data=entity)
+
+    def _session(self, message):
+        """Key of the device session a message was sent from
+
+        Stock Mycroft serves a single device and sets no 'session', so
+        all of its messages share one key ('' or the input named in
+        'source'). Satellites relayed to one instance, e.g. by HiveMind,
+        bring a 'session' or 'source' of their own.
+        """
+        context = message.context or {}
+        return context.get('session') or context.get('source') or ''
+
+    def _remember(self, message, entity_id, dev_name, domain='homeassistant'):
+        self.follow_up.remember(self._session(message), entity_id, dev_name,
+                                domain)
+
     @intent_handler('add.item.shopping.list.intent')
     def handle_shopping_list_intent(self, message):
         entity = message.data["entity"]
         ha_data = {'name': entity}
-        self.ha.execute_service("shopping_list", "add_item", ha_data)
-        self.speak_dialog("homeassistant.shopping.list")
+        if self._execute_service("shopping_list", "add_item", ha_data):
+            self.speak_dialog("homeassistant.shopping.list")
         return
 
     def _handle_light_adjust(self, message):
@@ -405,8 +730,8 @@ class HomeAssistantSkill(FallbackSkill):
         if not ha_entity or not self._check_availability(ha_entity):
             return
         ha_data = {'entity_id': ha_entity['id']}
-        # IDEA: set context for 'turn it off again' or similar
-        # self.set_context('Entity', ha_entity['dev_name'])
+        # 'turn it off again' refers to this entity
+        self._remember(message, ha_entity['id'], ha_entity['dev_name'])
 
         if action == "down":
             if ha_entity['state'] == "off":
@@ -422,9 +747,10 @@ class HomeAssistantSkill(FallbackSkill):
                     ha_data['brightness'] = light_attrs['unit_measure'] - brightness_value
                     if ha_data['brightness'] < min_brightness:
                         ha_data['brightness'] = min_brightness
-                    self.ha.execute_service("homeassistant",
-                                            "turn_on",
-                                            ha_data)
+                    if not self._execute_service("homeassistant",
+                                                 "turn_on",
+                                                 ha_data):
+                        return
                     ha_data['dev_name'] = ha_entity['dev_name']
                     ha_data['brightness'] = round(100 / max_brightness * ha_data['brightness'])
                     self.speak_dialog('homeassistant.brightness.decreased',
@@ -444,9 +770,10 @@ class HomeAssistantSkill(FallbackSkill):
                     ha_data['brightness'] = light_attrs['unit_measure'] + brightness_value
                     if ha_data['brightness'] > max_brightness:
                         ha_data['brightness'] = max_brightness
-                    self.ha.execute_service("homeassistant",
-                                            "turn_on",
-                                            ha_data)
+                    if not self._execute_service("homeassistant",
+                                                 "turn_on",
+                                                 ha_data):
+                        return
                     ha_data['dev_name'] = ha_entity['dev_name']
                     ha_data['brightness'] = round(100 / max_brightness * ha_data['brightness'])
                     self.speak_dialog('homeassistant.brightness.increased',
@@ -468,25 +795,29 @@ class HomeAssistantSkill(FallbackSkill):
             return
 
         ha_data = {'entity_id': ha_entity['id']}
-
-        # IDEA: set context for 'turn it off again' or similar
-        # self.set_context('Entity', ha_entity['dev_name'])
+        # 'turn it off' disables an automation, scenes and scripts go
+        # through the homeassistant domain
+        domain = ('automation' if ha_entity['id'].startswith('automation.')
+                  else 'homeassistant')
+        self._remember(message, ha_entity['id'], ha_entity['dev_name'],
+                       domain)
 
         self.log.debug("Triggered automation/scene/script: {}".format(ha_data))
         if "automation" in ha_entity['id']:
-            self.ha.execute_service('automation', 'trigger', ha_data)
+            if not self._execute_service('automation', 'trigger', ha_data):
+                return
             self.speak_dialog('homeassistant.automation.trigger',
                               data={"dev_name": ha_entity['dev_name']})
         elif "script" in ha_entity['id']:
-            self.speak_dialog('homeassistant.automation.trigger',
-                              data={"dev_name": ha_entity['dev_name']})
-            self.ha.execute_service("homeassistant", "turn_on",
-                                    data=ha_data)
+            if self._execute_service("homeassistant", "turn_on",
+                                     data=ha_data):
+                self.speak_dialog('homeassistant.automation.trigger',
+                                  data={"dev_name": ha_entity['dev_name']})
         elif "scene" in ha_entity['id']:
-            self.speak_dialog('homeassistant.device.on',
-                              data=ha_entity)
-            self.ha.execute_service("homeassistant", "turn_on",
-                                    data=ha_data)
+            if self._execute_service("homeassistant", "turn_on",
+                                     data=ha_data):
+                self.speak_dialog('homeassistant.device.on',
+                                  data=ha_entity)
 
     def _handle_sensor(self, message):
         entity = message.data["Entity"]
@@ -498,9 +829,8 @@ class HomeAssistantSkill(FallbackSkill):
             return
 
         entity = ha_entity['id']
-
-        # IDEA: set context for 'read it out again' or similar
-        # self.set_context('Entity', ha_entity['dev_name'])
+        # 'turn it off' after reading out a switch
+        self._remember(message, entity, ha_entity['dev_name'])
 
         unit_measurement = self.ha.find_entity_attr(entity)
         sensor_unit = unit_measurement.get('unit_measure') or ''
@@ -535,16 +865,227 @@ class HomeAssistantSkill(FallbackSkill):
             "dev_name": sensor_name,
             "value": sensor_state,
             "unit": sensor_unit})
-        # IDEA: Add some context if the person wants to look the unit up
-        # Maybe also change to name
-        # if one wants to look up "outside temperature"
-        # self.set_context("SubjectOfInterest", sensor_unit)
-
-    # In progress, still testing.
-    # Device location works.
-    # Proximity might be an issue
-    # - overlapping command for directions modules
-    # - (e.g. "How far is x from y?")
+
+    @intent_handler('sensor.summary.intent')
+    def handle_sensor_summary_intent(self, message):
+        spoken_class = message.data.get("device_class", "")
+        sensors = self._get_summary('sensor', spoken_class)
+        if sensors is False:
+            return
+        readings = []
+        for sensor in sensors:
+            if sensor['state'] in NO_VALUE_STATES:
+                continue
+            try:
+                value = nice_number(float(sensor['state']),
+                                    lang=self.language)
+            except ValueError:
+                value = sensor['state']
+            readings.append('{} {} {}'.format(
+                sensor['name'], value,
+                self._spoken_unit(sensor['unit'])).strip())
+        if not readings:
+            self.speak_dialog('homeassistant.sensor.summary.none',
+                              data={'device_class': spoken_class})
+            return
+        self.speak_dialog('homeassistant.sensor.summary', data={
+            'device_class': spoken_class,
+            'readings': join_list(readings,
+                                  self.translate('homeassistant.and'))})
+
+    @intent_handler('binary.summary.intent')
+    def handle_binary_summary_intent(self, message):
+        spoken_class = message.data.get("device_class", "")
+        spoken_state = message.data.get("state", "")
+        sensors = self._get_summary('binary_sensor', spoken_class)
+        if sensors is False:
+            return
+        # 'which windows are closed' asks for the ones that are off
+        wanted = 'off' if self.voc_match(spoken_state,
+                                         'BinaryInactive') else 'on'
+        names = [sensor['name'] for sensor in sensors
+                 if sensor['state'] == wanted]
+        if not names:
+            self.speak_dialog('homeassistant.binary.none', data={
+                'device_class': spoken_class, 'state': spoken_state})
+            return
+        self.speak_dialog('homeassistant.binary.active', data={
+            'names': join_list(names, self.translate('homeassistant.and')),
+            'device_class': spoken_class,
+            'state': spoken_state})
+
+    def _get_summary(self, domain, spoken_class):
+        """Entities of the spoken device class, False on errors"""
+        self._setup()
+        if self.ha is None:
+            self.speak_dialog('homeassistant.error.setup')
+            return False
+        try:
+            classes = self.translate_namedvalues(
+                'homeassistant.device_classes')
+        except FileNotFoundError:
+            classes = {}
+        spoken_class = spoken_class.lower().strip()
+        # 'humidity' needs no translation, plurals are stripped naively
+        device_class = classes.get(spoken_class,
+                                   spoken_class.rstrip('s').replace(' ', '_'))
+        return self._handle_client_exception(self.ha.summary, domain,
+                                             device_class)
+
+    def _spoken_unit(self, unit):
+        """Pronounceable name of a unit, parsed only once per unit"""
+        if unit not in self._unit_names:
+            spoken = unit or ''
+            # this is fully optional
+            try:
+                from quantulum3 import parser
+            except ImportError:
+                parser = None
+            if parser is not None and unit:
+                quantity = parser.parse(u'1 {}'.format(unit))
+                if (quantity and
+                        quantity[0].unit.name != "dimensionless"):
+                    spoken = quantity[0].unit.name
+            self._unit_names[unit] = spoken
+        return self._unit_names[unit]
+
+    @intent_handler('anything.on.intent')
+    def handle_anything_on_intent(self, message):
+        area = message.data.get("area", "")
+        index = self._get_membership()
+        key = index and self._find_container(index, area)
+        if not key:
+            return
+        count = index.active(key)
+        if count == 0:
+            self.speak_dialog('homeassistant.active.none',
+                              data={'area': index.label(key)})
+            return
+        self.speak_dialog('homeassistant.active.some', data={
+            'area': index.label(key),
+            'count': count,
+            'total': index.size(key)})
+
+    @intent_handler('count.on.intent')
+    def handle_count_on_intent(self, message):
+        area = message.data.get("area")
+        spoken_type = message.data.get("device_type", "")
+        index = self._get_membership()
+        if not index:
+            return
+        key = None
+        if area:
+            key = self._find_container(index, area)
+            if not key:
+                return
+        try:
+            types = self.translate_namedvalues('homeassistant.device_types')
+        except FileNotFoundError:
+            types = {}
+        # 'things' or 'devices' count all domains
+        domain = types.get(spoken_type.lower().strip()) or None
+        data = {'count': index.active(key, domain),
+                'total': index.size(key, domain),
+                'device_type': spoken_type}
+        if key is None:
+            self.speak_dialog('homeassistant.active.count', data=data)
+        else:
+            data['area'] = index.label(key)
+            self.speak_dialog('homeassistant.active.count.area', data=data)
+
+    def _get_membership(self):
+        """Group and area index of the HA client, False on errors"""
+        self._setup()
+        if self.ha is None:
+            self.speak_dialog('homeassistant.error.setup')
+            return False
+        return self._handle_client_exception(self.ha.membership)
+
+    def _find_container(self, index, area):
+        """Key of the spoken group or area, None after telling the user"""
+        key = index.find(area)
+        if key is None:
+            self.speak_dialog('homeassistant.area.unknown',
+                              data={'area': area})
+        return key
+
+    @intent_handler('sensor.history.intent')
+    def handle_sensor_history_intent(self, message):
+        stat = message.data.get("stat", "")
+        if self.voc_match(stat, "HistoryMinimum"):
+            aggregate = 'minimum'
+        elif self.voc_match(stat, "HistoryMaximum"):
+            aggregate = 'maximum'
+        elif self.voc_match(stat, "HistoryAverage"):
+            aggregate = 'mean'
+        else:
+            self.speak_dialog('homeassistant.error.sorry')
+            return
+
+        ha_entity = self._find_entity(message.data.get("entity"), ['sensor'])
+        if not ha_entity:
+            return
+        period, start = self._history_window(message)
+        series = self._handle_client_exception(self.ha.history,
+                                               ha_entity['id'], start)
+        if series is False:
+            return
+        if aggregate == 'mean':
+            value = series.mean(datetime.now().timestamp())
+        else:
+            value = getattr(series, aggregate)()
+        if value is None:
+            self.speak_dialog('homeassistant.history.empty', data={
+                "dev_name": ha_entity['dev_name'], "period": period})
+            return
+
+        attrs = self.ha.find_entity_attr(ha_entity['id']) or {}
+        self.speak_dialog('homeassistant.sensor.history', data={
+            "stat": stat,
+            "dev_name": ha_entity['dev_name'],
+            "period": period,
+            "value": nice_number(round(value, 1), lang=self.language),
+            "unit": attrs.get('unit_measure') or ''})
+
+    @intent_handler('sensor.duration.intent')
+    def handle_sensor_duration_intent(self, message):
+        ha_entity = self._find_entity(
+            message.data.get("entity"),
+            ['switch', 'light', 'fan', 'climate', 'input_boolean', 'group']
+        )
+        if not ha_entity:
+            return
+        period, start = self._history_window(message)
+        series = self._handle_client_exception(self.ha.history,
+                                               ha_entity['id'], start)
+        if series is False:
+            return
+        if not len(series):
+            self.speak_dialog('homeassistant.history.empty', data={
+                "dev_name": ha_entity['dev_name'], "period": period})
+            return
+
+        seconds = series.on_duration(datetime.now().timestamp())
+        self.speak_dialog('homeassistant.sensor.duration', data={
+            "dev_name": ha_entity['dev_name'],
+            "period": period,
+            "duration": nice_duration(int(seconds),
+                                      lang=self.language)})
+
+    def _history_window(self, message):
+        """Spoken period and its start as POSIX timestamp"""
+        period = message.data.get("period") or ""
+        midnight = datetime.now().replace(hour=0, minute=0, second=0,
+                                          microsecond=0)
+        if self.voc_match(period, "HistoryWeek"):
+            start = midnight - timedelta(days=midnight.weekday())
+        else:
+            # today is the default
+            start = midnight
+        return period, start.timestamp()
+
+    # Device location only, distances are answered by the
+    # tracker.closest/distance/near intents
     def handle_tracker_intent(self, message):
         entity = message.data["Entity"]
         self.log.debug("Entity: %s" % entity)
@@ -554,16 +1095,95 @@ class HomeAssistantSkill(FallbackSkill):
         if not ha_entity or not self._check_availability(ha_entity):
             return
 
-        # IDEA: set context for 'locate it again' or similar
-        # self.set_context('Entity', ha_entity['dev_name'])
-
         entity = ha_entity['id']
+        self._remember(message, entity, ha_entity['dev_name'])
         dev_name = ha_entity['dev_name']
         dev_location = ha_entity['state']
         self.speak_dialog('homeassistant.tracker.found',
                           data={'dev_name': dev_name,
                                 'location': dev_location})
 
+    @intent_handler('tracker.closest.intent')
+    def handle_tracker_closest_intent(self, message):
+        zone = self._find_entity(message.data.get("zone"),
+                                 ['zone', 'person', 'device_tracker'])
+        proximity = zone and self._get_proximity()
+        if not proximity:
+            return
+
+        ranked = proximity.ranked(zone['id'])
+        if not ranked:
+            self.speak_dialog('homeassistant.tracker.nobody',
+                              data={'zone': zone['dev_name']})
+            return
+        entity_id, meters = ranked[0]
+        distance, unit = self._spoken_distance(meters)
+        self.speak_dialog('homeassistant.tracker.closest',
+                          data={'dev_name': proximity.name(entity_id),
+                                'zone': zone['dev_name'],
+                                'distance': distance,
+                                'unit': unit})
+
+    @intent_handler('tracker.distance.intent')
+    def handle_tracker_distance_intent(self, message):
+        ha_entity = self._find_entity(message.data.get("entity"),
+                                      ['person', 'device_tracker'])
+        zone = ha_entity and self._find_entity(
+            message.data.get("zone"), ['zone', 'person', 'device_tracker'])
+        proximity = zone and self._get_proximity()
+        if not proximity:
+            return
+
+        meters = proximity.distance(ha_entity['id'], zone['id'])
+        if meters is None:
+            self.speak_dialog('homeassistant.tracker.noposition',
+                              data={'dev_name': ha_entity['dev_name']})
+            return
+        distance, unit = self._spoken_distance(meters)
+        self.speak_dialog('homeassistant.tracker.distance',
+                          data={'dev_name': ha_entity['dev_name'],
+                                'zone': zone['dev_name'],
+                                'distance': distance,
+                                'unit': unit})
+
+    @intent_handler('tracker.near.intent')
+    def handle_tracker_near_intent(self, message):
+        zone = self._find_entity(message.data.get("zone"),
+                                 ['zone', 'person', 'device_tracker'])
+        proximity = zone and self._get_proximity()
+        if not proximity:
+            return
+
+        near = [proximity.name(entity_id)
+                for entity_id, _ in proximity.near(zone['id'])]
+        if near:
+            names = join_list(near, self.translate('homeassistant.and'))
+            self.speak_dialog('homeassistant.tracker.near',
+                              data={'dev_name': names,
+                                    'zone': zone['dev_name']})
+        else:
+            self.speak_dialog('homeassistant.tracker.nobody',
+                              data={'zone': zone['dev_name']})
+
+    def _get_proximity(self):
+        """Distance index of the HA client, False on errors"""
+        return self._handle_client_exception(self.ha.proximity)
+
+    def _spoken_distance(self, meters):
+        """Convert meters to a (value, unit) pair for the dialogs"""
+        if self.config_core.get('system_unit') == 'imperial':
+            feet = meters / 0.3048
+            if feet < 1000:
+                value, unit = round(feet, -1), 'feet'
+            else:
+                value, unit = round(meters / 1609.344, 1), 'miles'
+        elif meters < 1000:
+            value, unit = round(meters, -1), 'meters'
+        else:
+            value, unit = round(meters / 1000, 1), 'kilometers'
+        return (nice_number(value, lang=self.language),
+                self.translate('homeassistant.unit.' + unit))
+
     @intent_handler('set.climate.intent')
     def handle_set_thermostat_intent(self, message):
         entity = message.data["entity"]
@@ -582,8 +1202,9 @@ class HomeAssistantSkill(FallbackSkill):
             'temperature': temperature
         }
         climate_attr = self.ha.find_entity_attr(ha_entity['id'])
-        self.ha.execute_service("climate", "set_temperature",
-                                data=climate_data)
+        if not self._execute_service("climate", "set_temperature",
+                                     data=climate_data):
+            return
         self.speak_dialog('homeassistant.set.thermostat',
                           data={
                               "dev_name": climate_attr['name'],
@@ -597,15 +1218,25 @@ class HomeAssistantSkill(FallbackSkill):
         if self.ha is None:
             self.speak_dialog('homeassistant.error.setup')
             return False
+        utterance = message.data.get('utterance')
+        # don't keep lower priority fallbacks waiting for HA to fail on
+        # utterances that don't mention anything at home
+        if (self.settings.get('fallback_gate', True) and
+                not self.fallback_gate.check(utterance)):
+            self.fallback_gate.record(utterance, False)
+            return False
         # pass message to HA-server
         response = self._handle_client_exception(
-            self.ha.engage_conversation,
-            message.data.get('utterance'))
+            self.ha.engage_conversation, utterance)
         if not response:
             return False
         # default non-parsing answer: "Sorry, I didn't understand that"
         answer = response.get('speech')
-        if not answer or answer == "Sorry, I didn't understand that":
+        understood = bool(answer and
+                          answer != "Sorry, I didn't understand that")
+        self.fallback_gate.record(utterance, True, understood)
+        self.log.debug('Fallback gate: {}'.format(self.fallback_gate.stats()))
+        if not understood:
             return False
 
         asked_question = False
@@ -618,6 +1249,9 @@ class HomeAssistantSkill(FallbackSkill):
 
     def shutdown(self):
         self.remove_fallback(self.handle_fallback)
+        if self.ha is not None:
+            # commands still waiting for their turn are not sent
+            self.ha.pace(None)
         super(HomeAssistantSkill, self).shutdown()
 
     def stop(self):
@@ -0,0 +1,229 @@
+"""Durable queue of service calls made while HA is unreachable"""
+import json
+import os
+from threading import Lock
+from time import time
+
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+
+
+# Seconds a queued command is still worth carrying out
+QUEUE_TTL = 10 * 60
+
+# Services that leave the same result if carried out late or twice
+QUEUEABLE_SERVICES = ('turn_on', 'turn_off', 'set_temperature')
+
+# Entities whose turn_on runs something instead of setting a state
+UNQUEUEABLE_DOMAINS = ('script', 'automation')
+
+
+class CommandQueued(Exception):
+    """HA is unreachable, the command will be sent once it is back"""
+
+
+def queueable(domain, service, data):
+    if service not in QUEUEABLE_SERVICES:
+        return False
+    data = data or {}
+    entity_id = data.get('entity_id')
+    if not isinstance(entity_id, str):
+        return False
+    # relative changes like brightness_step add up when sent late
+    if any('_step' in key for key in data):
+        return False
+    return entity_id.split(".")[0] not in UNQUEUEABLE_DOMAINS
+
+
+def _targets(command):
+    """Entity and kind of change of a command"""
+    domain, service, data = command
+    entity_id = data['entity_id']
+    if entity_id == 'all':
+        entity_id = '{}.all'.format(domain)
+    # turn_on and turn_off decide the same thing, other services don't
+    kind = 'state' if service in ('turn_on', 'turn_off') else service
+    return entity_id, kind
+
+
+def _keys(command):
+    """Data keys a command sets besides the entity"""
+    return frozenset(key for key in command[2] if key != 'entity_id')
+
+
+def _covers(command):
+    """Data keys a later command makes obsolete, None for all of them"""
+    # brightness or color of a light turned off afterwards don't matter
+    return None if command[1] == 'turn_off' else _keys(command)
+
+
+def _touches(group, entity_id):
+    """Check if a batch sets the state of an entity"""
+    if entity_id in group[4]:
+        return True
+    # 'all' covers its whole domain, or everything for homeassistant
+    return 'all' in group[4] and group[1] in (entity_id.split(".")[0],
+                                              'homeassistant')
+
+
+def batches(commands):
+    """Collapse superseded commands and merge the rest into batches
+
+    A command is dropped if a later one for the same entity (and kind of
+    change) sets at least the same keys; a plain turn_on after one with
+    a brightness keeps both. Commands with the same service and data are
+    merged into one call with a list of entity ids, unless that would
+    reorder two commands to the same entity. Returns (domain, service,
+    data) tuples.
+    """
+    # commands stored back after a partial replay are batches already
+    commands = [(domain, service, dict(data, entity_id=entity_id))
+                for domain, service, data in commands
+                for entity_id in (data['entity_id']
+                                  if isinstance(data['entity_id'], list)
+                                  else [data['entity_id']])]
+    # target -> keys covered by the kept commands after the current one
+    covered = {}
+    kept = []
+    for command in reversed(commands):
+        target = _targets(command)
+        keys = _keys(command)
+        if any(cover is None or cover >= keys
+               for cover in covered.get(target, ())):
+            continue
+        covered.setdefault(target, []).append(_covers(command))
+        kept.append(command)
+    kept.reverse()
+
+    # [signature, domain, service, data, entity ids]
+    groups = []
+    for domain, service, data in kept:
+        entity_id = data['entity_id']
+        rest = {key: value for key, value in data.items()
+                if key != 'entity_id'}
+        signature = (domain, service, json.dumps(rest, sort_keys=True))
+        target = None
+        for group in reversed(groups):
+            if group[0] == signature and entity_id != 'all' and \
+                    'all' not in group[4]:
+                target = group
+                break
+            if _touches(group, entity_id):
+                break
+        if target is None:
+            groups.append([signature, domain, service, rest, [entity_id]])
+        else:
+            target[4].append(entity_id)
+
+    result = []
+    for _, domain, service, rest, entity_ids in groups:
+        data = dict(rest)
+        data['entity_id'] = (entity_ids[0] if len(entity_ids) == 1
+                             else entity_ids)
+        result.append((domain, service, data))
+    return result
+
+
+class CommandQueue(object):
+    """Service calls waiting for HA, kept in an append-only file
+
+    Every command is appended as one JSON line and synced to disk, so
+    commands survive a restart of the skill. A line cut off by a crash is
+    skipped on reading.
+
+    Arguments:
+        path    file the commands are stored in
+        ttl     seconds after which a queued command is dropped
+    """
+
+    def __init__(self, path, ttl=QUEUE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = Lock()
+        # times the commands in the file were queued, so the length is
+        # known without reading the file
+        self._times = [queued for queued, _ in self._read()]
+
+    def __len__(self):
+        deadline = time() - self.ttl
+        with self._lock:
+            return sum(1 for queued in self._times if queued >= deadline)
+
+    def add(self, domain, service, data):
+        queued = time()
+        line = json.dumps({'time': queued, 'domain': domain,
+                           'service': service, 'data': data})
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._times.append(queued)
+
+    def pending(self):
+        """Commands that did not expire yet, in order of arrival"""
+        with self._lock:
+            return [command for _, command in self._read()]
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return []
+        deadline = time() - self.ttl
+        commands = []
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                if entry['time'] >= deadline:
+                    commands.append((entry['time'], (
+                        entry['domain'], entry['service'], entry['data'])))
+            except (ValueError, KeyError, TypeError):
+                continue
+        return commands
+
+    def _write(self, commands, queued):
+        """Replace the file with the given commands, queued at time"""
+        self._times = [queued] * len(commands)
+        if not commands:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            for domain, service, data in commands:
+                f.write(json.dumps({'time': queued, 'domain': domain,
+                                    'service': service,
+                                    'data': data}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+    def replay(self, execute):
+        """Send the queued commands in as few calls as possible
+
+        Arguments:
+            execute     function(domain, service, data) calling HA
+        Stops at the first call that does not reach HA and keeps it and
+        the following ones. Calls HA rejects are dropped.
+        Return:
+            number of calls sent
+        """
+        with self._lock:
+            entries = self._read()
+            pending = batches([command for _, command in entries])
+            sent = 0
+            try:
+                for domain, service, data in pending:
+                    try:
+                        execute(domain, service, data)
+                    except HTTPError:
+                        # e.g. the entity is gone, retrying won't help
+                        pass
+                    sent += 1
+            except (ConnectionError, Timeout):
+                pass
+            # the rest expires with the oldest of its commands
+            self._write(pending[sent:],
+                        min((queued for queued, _ in entries), default=0))
+            return sent
@@ -0,0 +1,245 @@
+"""Paced sending of service calls that switch many entities at once
+
+Zigbee and Z-Wave meshes drop commands when HA sends dozens of them at
+the same moment, e.g. for 'turn off all lights'. Such calls are split
+per entity and sent at a fixed rate per domain instead, while single
+commands spoken by the user go out right away unless they come faster
+than the rate themselves.
+"""
+from collections import OrderedDict
+from threading import Condition, Event, Lock, Thread
+from time import monotonic, sleep
+
+# Service calls per second sent for the entities of one domain
+DEFAULT_RATE = 10
+
+# Domains behind slower radios or devices, calls per second
+DOMAIN_RATES = {
+    'climate': 1,
+    'cover': 2
+}
+
+# Calls of a domain sent at once after an idle period
+BURST = 2
+
+
+def _domain(entity_id):
+    return entity_id.split(".")[0]
+
+
+def _entity_ids(data):
+    entity_ids = data.get('entity_id', ())
+    if isinstance(entity_ids, str):
+        return [entity_ids]
+    return list(entity_ids)
+
+
+class Ticket(object):
+    """Completion of a bulk call, tracked per entity
+
+    Attributes:
+        total       number of entities of the call
+        sent        calls sent successfully
+        dropped     calls replaced by a newer call for the same entity,
+                    or discarded when the scheduler stopped
+        errors      exceptions of the failed calls
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.sent = 0
+        self.dropped = 0
+        self.errors = []
+        self._lock = Lock()
+        self._done = Event()
+        if total == 0:
+            self._done.set()
+
+    @property
+    def pending(self):
+        with self._lock:
+            return self.total - self.sent - self.dropped - len(self.errors)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait until every entity was handled, False on timeout"""
+        return self._done.wait(timeout)
+
+    def _finish(self, error=None, dropped=False):
+        with self._lock:
+            if dropped:
+                self.dropped += 1
+            elif error is not None:
+                self.errors.append(error)
+            else:
+                self.sent += 1
+            if self.sent + self.dropped + len(self.errors) >= self.total:
+                self._done.set()
+
+
+class _Bucket(object):
+    """Token bucket limiting the calls per second of one domain"""
+
+    def __init__(self, rate, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    def take(self, now, force=False):
+        """Take a token, returns the seconds to wait if there is none
+
+        Forced takes reserve the next token even if there is none yet:
+        they go into debt and return the seconds until the token is due,
+        which also delays the calls that are not forced.
+        """
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if force:
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class DispatchScheduler(object):
+    """Sends service calls paced per domain, interactive calls first
+
+    Interactive calls are sent in the calling thread, ahead of queued bulk
+    work: they go out right away while their domain has tokens left, and
+    wait for the next token otherwise, so back-to-back commands are paced
+    as well. Bulk calls are split per entity, queued and sent by a
+    worker thread at the rate of the entity's domain; a call still
+    waiting for an entity is replaced by a newer one for it. The worker
+    exits when nothing is left to send.
+
+    A bulk call of n entities of a domain with rate r completes in about
+    n / r seconds.
+
+    Arguments:
+        send        callable(domain, service, data) doing the actual call
+        rate        calls per second per domain, unless in DOMAIN_RATES
+        on_error    callable(domain, service, data, error) told about
+                    failed bulk calls, which have no caller to raise to
+    """
+
+    def __init__(self, send, rate=DEFAULT_RATE, on_error=None):
+        self.send = send
+        self.rate = rate
+        self.on_error = on_error
+        self._cond = Condition()
+        # entity domain -> _Bucket
+        self._buckets = {}
+        # entity domain -> {entity_id: (domain, service, data, ticket)}
+        self._pending = OrderedDict()
+        self._worker = None
+
+    def set_rate(self, rate):
+        with self._cond:
+            self.rate = rate
+            self._buckets = {}
+            self._cond.notify()
+
+    def pending(self):
+        """Number of queued calls"""
+        with self._cond:
+            return sum(len(calls) for calls in self._pending.values())
+
+    def interactive(self, domain, service, data):
+        """Send a call now, dropping queued calls for its entities
+
+        Waits for the next token of the domain if none is left.
+        """
+        now = monotonic()
+        wait = 0
+        with self._cond:
+            for entity_id in _entity_ids(data):
+                self._drop(entity_id)
+                wait = max(wait, self._bucket(_domain(entity_id)).take(
+                    now, force=True))
+        if wait:
+            sleep(wait)
+        return self.send(domain, service, data)
+
+    def bulk(self, domain, service, data, entity_ids):
+        """Queue a call per entity
+
+        Return:
+            Ticket to track the completion of the calls
+        """
+        ticket = Ticket(len(entity_ids))
+        with self._cond:
+            for entity_id in entity_ids:
+                self._drop(entity_id)
+                self._pending.setdefault(_domain(entity_id), OrderedDict())[
+                    entity_id] = (domain, service,
+                                  dict(data, entity_id=entity_id), ticket)
+            if entity_ids and self._worker is None:
+                self._worker = Thread(target=self._run, daemon=True)
+                self._worker.start()
+            self._cond.notify()
+        return ticket
+
+    def cancel(self):
+        """Discard all queued calls"""
+        with self._cond:
+            for calls in self._pending.values():
+                for call in calls.values():
+                    call[3]._finish(dropped=True)
+            self._pending = OrderedDict()
+            self._cond.notify()
+
+    def _bucket(self, entity_domain):
+        if entity_domain not in self._buckets:
+            self._buckets[entity_domain] = _Bucket(
+                DOMAIN_RATES.get(entity_domain, self.rate))
+        return self._buckets[entity_domain]
+
+    def _drop(self, entity_id):
+        """Drop the queued call of an entity, lock must be held"""
+        calls = self._pending.get(_domain(entity_id))
+        if calls and entity_id in calls:
+            calls.pop(entity_id)[3]._finish(dropped=True)
+
+    def _next(self, now):
+        """Next call whose domain has a token, or the seconds to wait
+
+        Must be called with the lock held.
+        """
+        wait = None
+        for entity_domain, calls in list(self._pending.items()):
+            if not calls:
+                del self._pending[entity_domain]
+                continue
+            delay = self._bucket(entity_domain).take(now)
+            if delay == 0:
+                # domains take turns, a big one doesn't hold up the rest
+                self._pending.move_to_end(entity_domain)
+                return calls.popitem(last=False)[1], None
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                call, wait = self._next(monotonic())
+                while call is None:
+                    if not self._pending:
+                        self._worker = None
+                        return
+                    self._cond.wait(wait)
+                    call, wait = self._next(monotonic())
+            domain, service, data, ticket = call
+            try:
+                self.send(domain, service, data)
+            except Exception as e:
+                ticket._finish(error=e)
+                if self.on_error is not None:
+                    self.on_error(domain, service, data, e)
+            else:
+                ticket._finish()
@@ -0,0 +1,215 @@
+"""Selection and hedging across several base urls of one HA server"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from threading import Lock
+from time import monotonic
+
+from requests.exceptions import ConnectTimeout, ConnectionError, Timeout
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+
+# Number of latency samples kept per url
+SAMPLES = 50
+
+# Minimal number of samples before the p95 is trusted
+MIN_SAMPLES = 5
+
+# Hedge delay in seconds while there are too few samples
+DEFAULT_HEDGE_DELAY = 1.0
+
+# Timeout of the probe request in seconds
+PROBE_TIMEOUT = 3
+
+# Seconds after which the urls are raced again, devices roam
+REPROBE_INTERVAL = 5 * 60
+
+# Seconds between races while no url answers
+RACE_BACKOFF = 30
+
+# Kind of the latency samples of the probe request
+PROBE = 'probe'
+
+# Threads sending requests, shared by all concurrent handlers
+WORKERS = 16
+
+
+def _not_sent(error):
+    """Check if a failed request never reached the server"""
+    if isinstance(error, ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _close_result(future):
+    """Release the pooled connection of a response nobody reads"""
+    if not future.cancelled() and future.exception() is None:
+        close = getattr(future.result(), 'close', None)
+        if close is not None:
+            close()
+
+
+class Endpoint(object):
+    """A base url with its recent latencies per kind of request
+
+    Kinds are kept apart, a state list or history download takes longer
+    than a probe and must not set the hedge delay of the others.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        # kind -> latencies in seconds
+        self.samples = {}
+        self.failures = 0
+
+    def record(self, seconds, kind=PROBE):
+        if kind not in self.samples:
+            self.samples[kind] = deque(maxlen=SAMPLES)
+        self.samples[kind].append(seconds)
+        self.failures = 0
+
+    def fail(self):
+        self.failures += 1
+
+    @property
+    def score(self):
+        """Median probe latency, failing or unmeasured urls rank last
+
+        Only probes are sent to every url alike, so only they compare.
+        """
+        samples = self.samples.get(PROBE)
+        if self.failures or not samples:
+            return float('inf')
+        return sorted(samples)[len(samples) // 2]
+
+    def hedge_delay(self, kind):
+        """Seconds to wait before hedging, the p95 latency of kind"""
+        samples = self.samples.get(kind, ())
+        if len(samples) < MIN_SAMPLES:
+            return DEFAULT_HEDGE_DELAY
+        ordered = sorted(samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+
+class EndpointSelector(object):
+    """Routes requests to the fastest of several base urls
+
+    The urls are raced with a cheap probe; requests go to the winner.
+    If an idempotent request takes longer than the winner's p95 latency,
+    a duplicate is sent to the runner-up and the first answer is used.
+
+    Arguments:
+        urls    base urls in order of preference
+        probe   function(url, timeout) sending a cheap request to url
+    """
+
+    def __init__(self, urls, probe):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self._probe = probe
+        self._lock = Lock()
+        self._probed = None
+        self._closed = False
+        self._pool = ThreadPoolExecutor(max_workers=WORKERS,
+                                        thread_name_prefix='ha-endpoint')
+
+    def close(self):
+        """Stop the worker threads
+
+        Requests still sent through a closed selector go to the best url
+        in the calling thread, without racing or hedging.
+        """
+        self._closed = True
+        self._pool.shutdown(wait=False)
+
+    def _timed(self, endpoint, kind, send, *args):
+        start = monotonic()
+        try:
+            result = send(endpoint.url, *args)
+        except (ConnectionError, Timeout):
+            endpoint.fail()
+            raise
+        endpoint.record(monotonic() - start, kind)
+        return result
+
+    def race(self):
+        """Probe all urls at once, wait for the first answer
+
+        The remaining probes still record their latency, so the
+        runner-up is known as well.
+        """
+        try:
+            futures = [self._pool.submit(self._timed, endpoint, PROBE,
+                                         self._probe, PROBE_TIMEOUT)
+                       for endpoint in self.endpoints]
+        except RuntimeError:
+            # closed meanwhile, the pool takes no more work
+            return
+        for future in as_completed(futures):
+            if future.exception() is None:
+                break
+        self._probed = monotonic()
+
+    def ranked(self):
+        """Endpoints, fastest first, racing them again if needed"""
+        with self._lock:
+            if not self._closed and (
+                    self._probed is None or
+                    monotonic() - self._probed > REPROBE_INTERVAL or
+                    # while the server is down, not every request waits
+                    # for the probes to time out
+                    (all(endpoint.failures for endpoint in self.endpoints)
+                     and monotonic() - self._probed > RACE_BACKOFF)):
+                self.race()
+            # stable sort, equal scores keep the configured order
+            return sorted(self.endpoints, key=lambda e: e.score)
+
+    def request(self, send, idempotent=True, kind=None):
+        """Send a request via the best url
+
+        Arguments:
+            send        function(url) performing the request
+            idempotent  if the request may be sent twice
+            kind        requests of the same kind share latency samples
+        Throws the exception of the primary url if all urls fail.
+        """
+        primary, backup = self.ranked()[:2]
+        if not idempotent or self._closed:
+            return self._inline(primary, backup, kind, send)
+
+        try:
+            futures = [self._pool.submit(self._timed, primary, kind, send)]
+        except RuntimeError:
+            # closed after the check above
+            return self._inline(primary, backup, kind, send)
+        done, _ = wait(futures, timeout=primary.hedge_delay(kind))
+        if not done or isinstance(futures[0].exception(),
+                                  (ConnectionError, Timeout)):
+            try:
+                futures.append(self._pool.submit(self._timed, backup, kind,
+                                                 send))
+            except RuntimeError:
+                pass
+
+        error = None
+        for future in as_completed(futures):
+            exception = future.exception()
+            # an HTTP error status is an answer as well
+            if not isinstance(exception, (ConnectionError, Timeout)):
+                # the slower duplicate may hold a streamed connection
+                for other in futures:
+                    if other is not future:
+                        other.add_done_callback(_close_result)
+                return future.result()
+            if future is futures[0] or error is None:
+                error = exception
+        raise error
+
+    def _inline(self, primary, backup, kind, send):
+        """Send in the calling thread, to the backup if never sent"""
+        try:
+            return self._timed(primary, kind, send)
+        except ConnectionError as e:
+            # only safe to repeat if the first one never got out
+            if not _not_sent(e):
+                raise
+            return self._timed(backup, kind, send)
@@ -0,0 +1,35 @@
+from os import makedirs
+from os.path import dirname, join, isfile
+
+
+# Name of the Padatious entity used as {entity} in the .intent files
+ENTITY_NAME = 'entity'
+
+
+class EntityVocabulary(object):
+    """Keeps a generated Padatious .entity file in sync with HA names
+
+    The file is written to <directory>/<lang>/entity.entity and only
+    rewritten when the set of names changed.
+    """
+
+    def __init__(self, directory, lang):
+        self.path = join(directory, lang, ENTITY_NAME + '.entity')
+        self.names = set()
+        if isfile(self.path):
+            with open(self.path) as f:
+                self.names = set(line.strip() for line in f if line.strip())
+
+    def update(self, names):
+        """Write the entity file if the names changed.
+
+        Returns True if the file was (re)written.
+        """
+        names = set(name.lower().strip() for name in names if name.strip())
+        if names == self.names and isfile(self.path):
+            return False
+        makedirs(dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(sorted(names)) + '\n')
+        self.names = names
+        return True
@@ -0,0 +1,83 @@
+"""Local pre-classifier for the conversation fallback"""
+import re
+from collections import deque
+from threading import Lock
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+# Tokens too common to tell home commands from other questions
+_COMMON = frozenset(('the', 'and', 'for', 'with', 'from', 'all'))
+
+# Number of decisions kept for the precision statistics
+DECISION_LOG = 500
+
+
+def tokenize(text):
+    return set(token for token in _TOKEN.findall(text.lower())
+               if len(token) > 2 and token not in _COMMON)
+
+
+class FallbackGate(object):
+    """Decides if an utterance could plausibly be a home command
+
+    An utterance passes if it contains a word of a known entity or area
+    name, or at least two command keywords (like 'turn' and 'lights').
+    Until names are known every utterance passes.
+
+    The decisions are kept together with HA's verdict on the forwarded
+    utterances, so the precision of the gate can be measured.
+    """
+
+    def __init__(self, keywords=()):
+        self.keywords = frozenset(word.lower() for word in keywords)
+        self.names = frozenset()
+        self._entity_words = frozenset()
+        self._area_words = frozenset()
+        self.decisions = deque(maxlen=DECISION_LOG)
+        self._lock = Lock()
+
+    def update(self, names):
+        """Set the entity names utterances are checked against"""
+        self._entity_words = self._words(names)
+        self.names = self._entity_words | self._area_words
+
+    def update_areas(self, names):
+        """Set the area names utterances are checked against"""
+        self._area_words = self._words(names)
+        self.names = self._entity_words | self._area_words
+
+    @staticmethod
+    def _words(names):
+        vocabulary = set()
+        for name in names:
+            vocabulary |= tokenize(name)
+        return frozenset(vocabulary)
+
+    def check(self, utterance):
+        if not self.names:
+            return True
+        tokens = tokenize(utterance)
+        return bool(tokens & self.names or
+                    len(tokens & self.keywords) >= 2)
+
+    def record(self, utterance, forwarded, understood=None):
+        """Remember a decision and, if forwarded, HA's verdict"""
+        with self._lock:
+            self.decisions.append((utterance, forwarded, understood))
+
+    def stats(self):
+        """Counts of the logged decisions and the precision of the gate
+
+        Precision is the share of forwarded utterances HA understood,
+        None until one was forwarded.
+        """
+        with self._lock:
+            decisions = list(self.decisions)
+        forwarded = [understood for _, sent, understood in decisions
+                     if sent and understood is not None]
+        return {
+            'blocked': sum(1 for _, sent, _ in decisions if not sent),
+            'forwarded': len(forwarded),
+            'precision': (sum(forwarded) / len(forwarded)
+                          if forwarded else None)
+        }
@@ -0,0 +1,56 @@
+"""Entities a follow-up like 'turn it off' refers to, per device session"""
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+# Seconds a resolved entity can be referred to as 'it'
+FOLLOW_UP_TTL = 60
+
+# Sessions remembered at once, the least recently used is dropped
+MAX_SESSIONS = 64
+
+
+class FollowUpContext(object):
+    """Last resolved entity per session, forgotten after ttl seconds
+
+    Lets follow-up commands go straight to the service call, without
+    fetching states or matching names again.
+    """
+
+    def __init__(self, ttl=FOLLOW_UP_TTL, size=MAX_SESSIONS):
+        self.ttl = ttl
+        self.size = size
+        self._lock = Lock()
+        # session -> (monotonic time, entity)
+        self._sessions = OrderedDict()
+
+    def remember(self, session, entity_id, dev_name, domain='homeassistant'):
+        """Remember the entity a command of session was about
+
+        Arguments:
+            entity_id   entity id, or 'all' for every entity of domain
+            dev_name    spoken name for the answers
+            domain      domain of the services to call for the entity
+        """
+        entity = {'id': entity_id, 'dev_name': dev_name, 'domain': domain}
+        with self._lock:
+            self._sessions.pop(session, None)
+            self._sessions[session] = (monotonic(), entity)
+            while len(self._sessions) > self.size:
+                self._sessions.popitem(last=False)
+
+    def recall(self, session):
+        """The entity of the last command of session, None if expired"""
+        with self._lock:
+            remembered = self._sessions.get(session)
+            if remembered is None:
+                return None
+            if monotonic() - remembered[0] > self.ttl:
+                del self._sessions[session]
+                return None
+            self._sessions.move_to_end(session)
+            return remembered[1]
+
+    def forget(self, session):
+        with self._lock:
+            self._sessions.pop(session, None)
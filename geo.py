@@ -0,0 +1,145 @@
+"""Distances between device trackers, persons and zones"""
+import math
+from threading import Lock
+
+try:
+    from .lazy import lazy_import
+except ImportError:
+    # imported outside of the skill package (unittests)
+    from lazy import lazy_import
+
+# optional, distances are computed in pure python without it, and only
+# loaded when first used
+np = lazy_import('numpy')
+
+
+# Domains with a latitude/longitude position
+POSITION_DOMAINS = ['device_tracker', 'person', 'zone']
+
+# Mean earth radius in meters
+EARTH_RADIUS = 6371008.8
+
+# Minimal distance in meters to count as near a place without radius
+NEAR_DISTANCE = 200
+
+
+def haversine_matrix(lats, lons):
+    """Great circle distances in meters between all pairs of positions
+
+    Computed as one vectorized expression over arrays if numpy is
+    available. Returns an N x N nested sequence, indexable as [i][j].
+    """
+    if np is not None:
+        lat = np.radians(np.asarray(lats, dtype=float))
+        lon = np.radians(np.asarray(lons, dtype=float))
+        dlat = lat[:, None] - lat[None, :]
+        dlon = lon[:, None] - lon[None, :]
+        a = (np.sin(dlat / 2) ** 2 +
+             np.cos(lat[:, None]) * np.cos(lat[None, :]) *
+             np.sin(dlon / 2) ** 2)
+        return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+    lat = [math.radians(value) for value in lats]
+    lon = [math.radians(value) for value in lons]
+    cos_lat = [math.cos(value) for value in lat]
+    return [[2 * EARTH_RADIUS * math.asin(math.sqrt(min(1, max(0,
+             math.sin((lat[i] - lat[j]) / 2) ** 2 +
+             cos_lat[i] * cos_lat[j] *
+             math.sin((lon[i] - lon[j]) / 2) ** 2))))
+             for j in range(len(lat))] for i in range(len(lat))]
+
+
+class ProximityIndex(object):
+    """Pairwise distances of all positioned entities
+
+    The distance matrix is computed once and reused until any position
+    changes.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # entity_id -> (latitude, longitude)
+        self._positions = {}
+        self._index = {}
+        self._names = {}
+        self._radius = {}
+        self._matrix = None
+
+    def update(self, states):
+        """Feed the current states, recomputes distances on changes"""
+        positions = {}
+        names = {}
+        radius = {}
+        for state in states:
+            attributes = state['attributes']
+            try:
+                position = (float(attributes['latitude']),
+                            float(attributes['longitude']))
+            except (KeyError, TypeError, ValueError):
+                continue
+            positions[state['entity_id']] = position
+            names[state['entity_id']] = attributes.get(
+                'friendly_name', state['entity_id'])
+            if 'radius' in attributes:
+                radius[state['entity_id']] = attributes['radius']
+
+        with self._lock:
+            self._names = names
+            self._radius = radius
+            if positions == self._positions:
+                return
+            self._positions = positions
+            self._index = {entity_id: i
+                           for i, entity_id in enumerate(positions)}
+            self._matrix = None
+
+    def _distances(self):
+        """Return the matrix and the index map, computing it if needed"""
+        with self._lock:
+            if self._matrix is None and self._positions:
+                lats, lons = zip(*self._positions.values())
+                self._matrix = haversine_matrix(lats, lons)
+            return self._matrix, self._index
+
+    def name(self, entity_id):
+        return self._names.get(entity_id, entity_id)
+
+    def distance(self, entity_id, target_id):
+        """Distance in meters between two entities or None if unknown"""
+        matrix, index = self._distances()
+        if entity_id not in index or target_id not in index:
+            return None
+        return float(matrix[index[entity_id]][index[target_id]])
+
+    def movers(self):
+        """Domains of the entities to rank, persons if there are any
+
+        A person is positioned by its device trackers, ranking both would
+        name everyone twice.
+        """
+        if any(entity_id.startswith('person.') for entity_id in self._index):
+            return ('person',)
+        return ('device_tracker',)
+
+    def ranked(self, target_id, domains=None):
+        """Entities of the given domains sorted by distance to target
+
+        Returns a list of (entity_id, meters) tuples.
+        """
+        domains = domains or self.movers()
+        matrix, index = self._distances()
+        if target_id not in index:
+            return []
+        row = matrix[index[target_id]]
+        result = [(entity_id, float(row[i]))
+                  for entity_id, i in index.items()
+                  if entity_id != target_id and
+                  entity_id.split(".")[0] in domains]
+        return sorted(result, key=lambda item: item[1])
+
+    def near(self, target_id, domains=None):
+        """Entities within the radius of a zone (or NEAR_DISTANCE)"""
+        radius = max(self._radius.get(target_id) or 0, NEAR_DISTANCE)
+        return [(entity_id, meters)
+                for entity_id, meters in self.ranked(target_id, domains)
+                if meters <= radius]
@@ -1,7 +1,36 @@
-from requests import get, post
-from fuzzywuzzy import fuzz
+from requests import Session
 import json
-from requests.exceptions import Timeout, RequestException
+from time import monotonic
+from datetime import datetime, timezone
+from threading import Event, Lock
+from urllib.parse import quote
+from requests.exceptions import (ConnectionError, Timeout, RequestException,
+                                 HTTPError)
+
+try:
+    from .state_cache import StateCache, DEFAULT_BUDGET, RELEVANT_DOMAINS
+    from .geo import ProximityIndex, POSITION_DOMAINS
+    from .endpoints import EndpointSelector
+    from .history import HistoryCache, iter_objects
+    from .command_queue import CommandQueued, queueable
+    from .normalize import Normalizer
+    from .lazy import lazy_import
+    from .membership import MembershipIndex
+    from .dispatch import DispatchScheduler
+except ImportError:
+    # imported outside of the skill package (unittests)
+    from state_cache import StateCache, DEFAULT_BUDGET, RELEVANT_DOMAINS
+    from geo import ProximityIndex, POSITION_DOMAINS
+    from endpoints import EndpointSelector
+    from history import HistoryCache, iter_objects
+    from command_queue import CommandQueued, queueable
+    from normalize import Normalizer
+    from lazy import lazy_import
+    from membership import MembershipIndex
+    from dispatch import DispatchScheduler
+
+# loaded when the first name is matched, not with the skill
+fuzz = lazy_import('fuzzywuzzy.fuzz')
 
 
 __author__ = 'btotharye'
@@ -9,10 +38,79 @@ __author__ = 'btotharye'
 # Timeout time for HA requests
 TIMEOUT = 10
 
+# Seconds the areas of the HA registry are reused before asking again
+AREA_TTL = 10 * 60
+
+# Seconds the group members and counts are kept up to date by the
+# answers of service calls alone, before all states are fetched again
+MEMBERSHIP_TTL = 60
+
+# Renders all areas with their entities as a JSON list of [name, ids]
+AREA_TEMPLATE = (
+    "{% set ns = namespace(areas=[]) %}"
+    "{% for area in areas() %}"
+    "{% set ns.areas = ns.areas + [[area_name(area), area_entities(area)]] %}"
+    "{% endfor %}"
+    "{{ ns.areas | tojson }}")
+
+# Domains whose 'all' calls are split per entity when paced
+PACED_DOMAINS = ('light', 'switch', 'fan', 'cover', 'climate')
+
+
+class _Call(object):
+    """A request in flight, shared by all callers waiting for it"""
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls with the same key into one call
+
+    The first caller of a key runs the function, callers arriving while
+    it is in flight wait for it and share its result or exception.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
 
 class HomeAssistantClient(object):
+    """Client for the Home Assistant REST API
 
-    def __init__(self, host, token, portnum, ssl=False, verify=True):
+    Instances are thread-safe and meant to be shared by all handlers:
+    concurrent identical fetches are coalesced into one request.
+    """
+
+    def __init__(self, host, token, portnum, ssl=False, verify=True,
+                 cache_budget=DEFAULT_BUDGET, urls=None, lang=None):
         self.ssl = ssl
         self.verify = verify
         if self.ssl:
@@ -25,22 +123,129 @@ class HomeAssistantClient(object):
             'Authorization': "Bearer {}".format(token),
             'Content-Type': 'application/json'
         }
+        # names are matched in the form of the spoken language
+        self.cache = StateCache(budget=cache_budget,
+                                normalizer=Normalizer(lang))
+        # called with the list of friendly names whenever they change
+        self.names_listener = None
+        # called with the list of area names whenever they change
+        self.areas_listener = None
+        self._names_version = 0
+        # the connection pool of a Session is safe to share among threads
+        self.session = Session()
+        self._flight = SingleFlight()
+        self._update_lock = Lock()
+        self._proximity = ProximityIndex()
+        self._history = HistoryCache(self._fetch_history)
+        self._membership = MembershipIndex(self.cache.normalize)
+        self._membership_updated = None
+        self._areas_fetched = None
+        # CommandQueue for service calls while HA is unreachable, if any
+        self.queue = None
+        # DispatchScheduler pacing calls for many entities, if any
+        self.dispatcher = None
+        # further base urls of the same server, e.g. local and remote
+        self.endpoints = None
+        if urls:
+            self.endpoints = EndpointSelector([self.url] + list(urls),
+                                              self._probe)
+
+    def close(self):
+        """Release the threads of a client that is being replaced"""
+        if self.endpoints is not None:
+            self.endpoints.close()
+
+    def _request(self, method, path, data=None, stream=False):
+        """Send a request to the HA server
+
+        With several base urls, the fastest one is used and GET requests
+        are hedged on the runner-up.
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        if self.endpoints is None:
+            return self._send(self.url, method, path, data, stream=stream)
+        # e.g. '/api/states' or '/api/history', without ids and times
+        kind = '/'.join(path.split('?')[0].split('/')[:3])
+        return self.endpoints.request(
+            lambda url: self._send(url, method, path, data, stream=stream),
+            idempotent=(method == 'GET'), kind=kind)
+
+    def _send(self, url, method, path, data=None, timeout=TIMEOUT,
+              stream=False):
+        kwargs = {'stream': stream}
+        if url.startswith('https'):
+            kwargs['verify'] = self.verify
+        if data is not None:
+            kwargs['data'] = json.dumps(data)
+        r = self.session.request(method, "{}{}".format(url, path),
+                                 headers=self.headers, timeout=timeout,
+                                 **kwargs)
+        r.raise_for_status()
+        return r
+
+    def _probe(self, url, timeout):
+        """Cheapest request to check if url reaches the server"""
+        return self._send(url, 'GET', '/api/', timeout=timeout)
 
     def _get_state(self):
-        """Get state object
+        """Get state object, pruned to the domains and attributes in use
+
+        Refreshes the state cache on every call. Concurrent calls share a
+        single request, unless a service call invalidated the cache while
+        the request was in flight.
 
         Throws request Exceptions
         (Subclasses of ConnectionError or RequestException,
           raises HTTPErrors if non-Ok status code)
         """
-        if self.ssl:
-            req = get("{}/api/states".format(self.url), headers=self.headers,
-                      verify=self.verify, timeout=TIMEOUT)
-        else:
-            req = get("{}/api/states".format(self.url), headers=self.headers,
-                      timeout=TIMEOUT)
-        req.raise_for_status()
-        return req.json()
+        generation = self.cache.generation
+        return self._flight.do(('states', generation),
+                               self._fetch_state, generation)
+
+    def _fetch_state(self, generation):
+        req = self._request('GET', '/api/states')
+        states = req.json()
+        # leaders of fetches before and after an invalidate() can get
+        # here at the same time, the mirrors are updated one at a time
+        names = None
+        with self._update_lock:
+            states = self.cache.update(states, generation)
+            self._membership.update(states)
+            self._membership_updated = monotonic()
+            if self.cache.names_version != self._names_version:
+                self._names_version = self.cache.names_version
+                names = self.cache.names()
+        # the listener registers vocabulary, which must not hold up the
+        # other fetches
+        if names is not None and self.names_listener is not None:
+            self.names_listener(names)
+        return states
+
+    def _get_states(self, domains):
+        """Get the states of the given domains, cached if still fresh
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        """
+        if isinstance(domains, str):
+            domains = [domains]
+        if self.cache.is_fresh(domains):
+            return self.cache.get(domains)
+        self.cache.touch(domains)
+        try:
+            states = self._get_state()
+        except (ConnectionError, Timeout):
+            # commands for HA are queued, so resolve names from the last
+            # known states
+            if self.queue is None or not self.cache.domains():
+                raise
+            return self.cache.get(domains)
+        return [state for state in states
+                if state['entity_id'].split(".")[0] in domains]
 
     def connected(self):
         try:
@@ -56,20 +261,34 @@ class HomeAssistantClient(object):
         (Subclasses of ConnectionError or RequestException,
           raises HTTPErrors if non-Ok status code)
         """
-        json_data = self._get_state()
+        json_data = self._get_states(types)
+        # names pinned by the intent parser resolve without fuzzy matching
+        entity_id = self.cache.lookup(entity, types)
+        for state in json_data or ():
+            if state['entity_id'] == entity_id:
+                return {
+                    "id": entity_id,
+                    "dev_name": state['attributes'].get('friendly_name',
+                                                        entity_id),
+                    "state": state['state'],
+                    "best_score": 100}
         # require a score above 50%
         best_score = 50
         best_entity = None
+        # normalized once, the names were normalized with the index
+        phrase = self.cache.normalize(entity)
         if json_data:
             for state in json_data:
                 try:
                     if state['entity_id'].split(".")[0] in types:
                         # something like temperature outside
                         # should score on "outside temperature sensor"
-                        # and repetitions should not count on my behalf
-                        score = fuzz.token_sort_ratio(
-                            entity,
-                            state['attributes']['friendly_name'].lower())
+                        # and repetitions should not count on my behalf,
+                        # the normalized forms are sorted already
+                        name_form, id_form = self.cache.forms(
+                            state['entity_id'],
+                            state['attributes']['friendly_name'])
+                        score = fuzz.ratio(phrase, name_form)
                         if score > best_score:
                             best_score = score
                             best_entity = {
@@ -78,9 +297,7 @@ class HomeAssistantClient(object):
                                 ['friendly_name'],
                                 "state": state['state'],
                                 "best_score": best_score}
-                        score = fuzz.token_sort_ratio(
-                            entity,
-                            state['entity_id'].lower())
+                        score = fuzz.ratio(phrase, id_form)
                         if score > best_score:
                             best_score = score
                             best_entity = {
@@ -100,7 +317,7 @@ class HomeAssistantClient(object):
         (Subclasses of ConnectionError or RequestException,
           raises HTTPErrors if non-Ok status code)
         """
-        json_data = self._get_state()
+        json_data = self._get_states([entity.split(".")[0]])
 
         if json_data:
             for attr in json_data:
@@ -127,23 +344,210 @@ class HomeAssistantClient(object):
                     return entity_attr
         return None
 
+    def summary(self, domain, device_class):
+        """All entities of a domain with the given device class
+
+        Selected in one pass over a single state snapshot.
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        Return:
+            list of dicts {'id', 'name', 'state', 'unit'} sorted by name
+        """
+        entities = []
+        for state in self._get_states([domain]):
+            attributes = state['attributes']
+            if attributes.get('device_class') != device_class:
+                continue
+            entities.append({
+                "id": state['entity_id'],
+                "name": attributes.get('friendly_name', state['entity_id']),
+                "state": state['state'],
+                "unit": attributes.get('unit_of_measurement')})
+        return sorted(entities, key=lambda entity: entity['name'].lower())
+
+    def proximity(self):
+        """Distances between all device trackers, persons and zones
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        Return:
+            ProximityIndex, distances are only recomputed if a position
+            changed since the last call
+        """
+        self._proximity.update(self._get_states(POSITION_DOMAINS))
+        return self._proximity
+
+    def membership(self):
+        """Members of all groups and areas and how many of them are on
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        Return:
+            MembershipIndex, memberships are only rebuilt if a group or
+            area changed since the last call
+        """
+        # every state download updates the index, service calls adjust
+        # it with the states they changed
+        if (self._membership_updated is None or
+                monotonic() - self._membership_updated > MEMBERSHIP_TTL):
+            self._get_state()
+        if (self._areas_fetched is None or
+                monotonic() - self._areas_fetched > AREA_TTL):
+            self._flight.do('areas', self._fetch_areas)
+        return self._membership
+
+    def _fetch_areas(self):
+        try:
+            r = self._request('POST', '/api/template',
+                              {'template': AREA_TEMPLATE})
+            # HA renders the template as text, which is JSON here
+            areas = dict(r.json())
+        except (HTTPError, ValueError, TypeError):
+            # HA before 2021.10 can't render areas, groups still work
+            areas = {}
+        if (self._membership.set_areas(areas) and
+                self.areas_listener is not None):
+            self.areas_listener(list(areas))
+        self._areas_fetched = monotonic()
+
+    def _fetch_history(self, entity_id, start):
+        """Download the state changes of an entity since start
+
+        The response is parsed while it streams in, rows are yielded one
+        by one.
+        """
+        since = datetime.fromtimestamp(start, timezone.utc).isoformat()
+        # without an end HA stops one day after start
+        until = datetime.now(timezone.utc).isoformat()
+        r = self._request(
+            'GET', '/api/history/period/{}?filter_entity_id={}'
+            '&end_time={}&minimal_response&no_attributes'.format(
+                quote(since), quote(entity_id), quote(until)),
+            stream=True)
+        with r:
+            for row in iter_objects(r.iter_content(chunk_size=8192)):
+                yield row
+
+    def history(self, entity_id, start):
+        """State history of an entity since start (POSIX timestamp)
+
+        Cached per (entity, start); a repeated question only downloads
+        the changes since the last one.
+
+        Throws request Exceptions
+        (Subclasses of ConnectionError or RequestException,
+          raises HTTPErrors if non-Ok status code)
+        Return:
+            HistorySeries
+        """
+        return self._history.get(entity_id, start)
+
+    def pace(self, rate, on_error=None):
+        """Send calls for many entities at rate calls per second
+
+        A rate of None sends every call right away again. on_error is
+        called with (domain, service, data, exception) for every paced
+        call that failed.
+        """
+        if rate is None:
+            if self.dispatcher is not None:
+                self.dispatcher.cancel()
+            self.dispatcher = None
+        elif self.dispatcher is None:
+            self.dispatcher = DispatchScheduler(self._call_service, rate,
+                                                on_error)
+        else:
+            self.dispatcher.set_rate(rate)
+            self.dispatcher.on_error = on_error
+
     def execute_service(self, domain, service, data):
         """Execute service at HAServer
 
+        While paced, calls for several entities or for 'all' entities of
+        a domain are queued per entity and a dispatch.Ticket is returned
+        right away.
+
         Throws request Exceptions
         (Subclasses of ConnectionError or RequestException,
           raises HTTPErrors if non-Ok status code)
+        Raises CommandQueued instead if HA is unreachable and the call
+        was queued to be sent later.
         """
-        if self.ssl:
-            r = post("{}/api/services/{}/{}".format(self.url, domain, service),
-                     headers=self.headers, data=json.dumps(data),
-                     verify=self.verify, timeout=TIMEOUT)
-        else:
-            r = post("{}/api/services/{}/{}".format(self.url, domain, service),
-                     headers=self.headers, data=json.dumps(data),
-                     timeout=TIMEOUT)
-        r.raise_for_status()
-        return r
+        dispatcher = self.dispatcher
+        if dispatcher is None:
+            return self._call_service(domain, service, data)
+        entity_ids = self._bulk_targets(domain, service, data)
+        if entity_ids is None:
+            return dispatcher.interactive(domain, service, data)
+        return dispatcher.bulk(domain, service, data, entity_ids)
+
+    def _bulk_targets(self, domain, service, data):
+        """Entities a call is split into, None to send it as it is"""
+        entity_ids = data.get('entity_id')
+        if entity_ids == 'all':
+            if domain not in PACED_DOMAINS or domain not in RELEVANT_DOMAINS:
+                return None
+            states = self._get_states([domain])
+            if not states:
+                # no entities known, HA decides what 'all' is
+                return None
+            if set(data) == {'entity_id'}:
+                # 'all off' needs no call for the lights already off
+                target = {'turn_on': 'on', 'turn_off': 'off'}.get(service)
+                states = [state for state in states
+                          if state['state'] != target]
+            return [state['entity_id'] for state in states]
+        if isinstance(entity_ids, (list, tuple)) and len(entity_ids) > 1:
+            return list(entity_ids)
+        return None
+
+    def _call_service(self, domain, service, data):
+        path = '/api/services/{}/{}'.format(domain, service)
+        queue = self.queue if queueable(domain, service, data) else None
+        try:
+            if queue is not None and len(queue):
+                # HA was away, the queued commands go first to keep the
+                # order, this one is queued as well if HA still is
+                self.replay_queue()
+                if len(queue):
+                    queue.add(domain, service, data)
+                    raise CommandQueued()
+            r = self._request('POST', path, data)
+            try:
+                # HA answers with the states the service changed
+                self._membership.apply(r.json())
+            except (ValueError, TypeError, KeyError):
+                pass
+            return r
+        except (ConnectionError, Timeout):
+            if queue is None:
+                raise
+            queue.add(domain, service, data)
+            raise CommandQueued()
+        finally:
+            # the service most likely changed some states
+            self.cache.invalidate()
+
+    def replay_queue(self):
+        """Send the service calls queued while HA was unreachable
+
+        Return:
+            number of calls sent, superseded commands are collapsed and
+            the rest merged into as few calls as possible
+        """
+        if self.queue is None:
+            return 0
+        try:
+            return self.queue.replay(
+                lambda domain, service, data: self._request(
+                    'POST', '/api/services/{}/{}'.format(domain, service),
+                    data))
+        finally:
+            self.cache.invalidate()
 
     def find_component(self, component):
         """Check if a component is loaded at the HA-Server
@@ -152,16 +556,10 @@ class HomeAssistantClient(object):
         (Subclasses of ConnectionError or RequestException,
           raises HTTPErrors if non-Ok status code)
         """
-        if self.ssl:
-            req = get("{}/api/components".format(self.url),
-                      headers=self.headers, verify=self.verify,
-                      timeout=TIMEOUT)
-        else:
-            req = get("%s/api/components" % self.url, headers=self.headers,
-                      timeout=TIMEOUT)
-
-        req.raise_for_status()
-        return component in req.json()
+        components = self._flight.do(
+            'components',
+            lambda: self._request('GET', '/api/components').json())
+        return component in components
 
     def engage_conversation(self, utterance):
         """Engage the conversation component at the Home Assistant server
@@ -179,18 +577,5 @@ class HomeAssistantClient(object):
         data = {
             "text": utterance
         }
-        if self.ssl:
-            r = post("{}/api/conversation/process".format(self.url),
-                     headers=self.headers,
-                     data=json.dumps(data),
-                     verify=self.verify,
-                     timeout=TIMEOUT
-                     )
-        else:
-            r = post("{}/api/conversation/process".format(self.url),
-                     headers=self.headers,
-                     data=json.dumps(data),
-                     timeout=TIMEOUT
-                     )
-        r.raise_for_status()
+        r = self._request('POST', '/api/conversation/process', data)
         return r.json()['speech']['plain']
@@ -0,0 +1,372 @@
+"""Local caching proxy shared by all Mycroft devices of one home
+
+The daemon keeps a single state mirror of the Home Assistant server and
+serves it to every skill instance on the LAN, so the load on HA scales
+with the number of homes instead of devices times utterances:
+
+    python3 ha_proxy.py --host 192.168.0.10 --token <token> --listen :8124
+
+Then set "Local caching proxy" to <proxy-host>:8124 in the skill settings.
+
+Protocol: every message is a 4 byte big-endian length followed by zlib
+compressed JSON. A request carries the HA token and an op:
+
+    {"op": "states", "since": <version>}
+        -> {"version": v, "states": [...]}, states omitted if unchanged
+    {"op": "get", "path": "/api/..."}
+        -> {"status": code, "body": ...}, cached for a short time
+    {"op": "post", "path": "/api/...", "data": {...}}
+        -> {"status": code, "body": ...}, forwarded to HA
+"""
+import argparse
+import hmac
+import json
+import logging
+import socket
+import struct
+import zlib
+from collections import OrderedDict
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from requests import Request
+from requests.exceptions import (
+    ConnectionError,
+    HTTPError,
+    RequestException,
+    Timeout)
+
+try:
+    from .ha_client import HomeAssistantClient, TIMEOUT
+    from .state_cache import prune_state
+except ImportError:
+    # started as a script or imported by the unittests
+    from ha_client import HomeAssistantClient, TIMEOUT
+    from state_cache import prune_state
+
+
+# Default port of the proxy
+PROXY_PORT = 8124
+
+# Seconds between two state downloads of the proxy
+POLL_INTERVAL = 2
+
+# Seconds without a request after which the proxy stops polling HA
+IDLE_AFTER = 60
+
+# Seconds GET replies other than the states are cached by the proxy
+GET_TTL = 30
+
+# GET replies cached at most, history paths differ on every request
+GET_CACHE_SIZE = 128
+
+_HEADER = struct.Struct('>I')
+
+LOG = logging.getLogger(__name__)
+
+# Upper bound of a single message, protects the daemon against garbage
+MAX_MESSAGE = 64 * 1024 * 1024
+
+
+def send_message(sock, message):
+    payload = zlib.compress(json.dumps(message).encode())
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('connection closed')
+        data += chunk
+    return data
+
+
+def recv_message(sock):
+    size, = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    if size > MAX_MESSAGE:
+        raise ValueError('message too large')
+    return json.loads(zlib.decompress(_recv_exactly(sock, size)).decode())
+
+
+class _ProxyHandler(StreamRequestHandler):
+
+    def handle(self):
+        proxy = self.server.proxy
+        while True:
+            try:
+                request = recv_message(self.connection)
+            except (EOFError, OSError, ValueError):
+                return
+            send_message(self.connection, proxy.handle(request))
+
+
+class HomeAssistantProxy(object):
+    """State mirror of one HA server, served over TCP
+
+    Uses a HomeAssistantClient for the connection to HA, so the mirror
+    holds the same pruned states the skill works with.
+    """
+
+    def __init__(self, client, token, listen=('0.0.0.0', PROXY_PORT),
+                 interval=POLL_INTERVAL):
+        self.client = client
+        self.token = token
+        self.interval = interval
+        self.version = 0
+        self.states = []
+        self._lock = Lock()
+        # monotonic time of the last request, polls stop IDLE_AFTER it
+        self._requested = monotonic()
+        # path -> (monotonic time, reply), oldest first
+        self._get_cache = OrderedDict()
+        self._stopped = Event()
+        self._refresh = Event()
+        self._server = ThreadingTCPServer(listen, _ProxyHandler,
+                                          bind_and_activate=False)
+        self._server.allow_reuse_address = True
+        self._server.daemon_threads = True
+        self._server.server_bind()
+        self._server.server_activate()
+        self._server.proxy = self
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def poll(self):
+        """Download the states once, bump the version if they changed"""
+        states = self.client._get_state()
+        with self._lock:
+            if states != self.states:
+                self.states = states
+                self.version += 1
+
+    def _try_poll(self):
+        try:
+            self.poll()
+        except RequestException:
+            # HA restarting, keep serving the last known states
+            pass
+        except ValueError as e:
+            LOG.warning('Invalid state list from HA: {}'.format(e))
+
+    def _idle(self):
+        return monotonic() - self._requested > IDLE_AFTER
+
+    def _poll_loop(self):
+        while not self._stopped.is_set():
+            if self._idle():
+                # nobody asks, HA is left alone until a request wakes us
+                self._refresh.wait()
+            else:
+                self._try_poll()
+                self._refresh.wait(self.interval)
+            self._refresh.clear()
+
+    def handle(self, request):
+        """Answer a single protocol request"""
+        if not isinstance(request, dict):
+            return {'status': 400, 'body': {'message': 'Bad request'}}
+        # compared as bytes, compare_digest refuses non-ASCII strings
+        if not hmac.compare_digest(str(request.get('token', '')).encode(),
+                                   self.token.encode()):
+            return {'status': 401, 'body': {'message': 'Unauthorized'}}
+        idle = self._idle()
+        self._requested = monotonic()
+        if idle:
+            # resume polling
+            self._refresh.set()
+        op = request.get('op')
+        try:
+            if op == 'states':
+                if idle:
+                    # the mirror went stale while nobody asked
+                    self._try_poll()
+                with self._lock:
+                    reply = {'status': 200, 'version': self.version}
+                    if request.get('since') != self.version:
+                        reply['states'] = self.states
+                return reply
+            if op == 'get':
+                return self._get(request['path'])
+            if op == 'post':
+                r = self.client._request('POST', request['path'],
+                                         request.get('data'))
+                body = r.json()
+                if request['path'].startswith('/api/services/'):
+                    self._apply_changes(body)
+                return {'status': r.status_code, 'body': body}
+        except HTTPError as e:
+            return {'status': e.response.status_code,
+                    'body': {'message': e.response.reason}}
+        except RequestException:
+            return {'status': 504, 'body': {'message': 'HA unreachable'}}
+        except ValueError:
+            # HA answered with something else than JSON
+            return {'status': 502, 'body': {'message': 'Invalid reply'}}
+        except (KeyError, TypeError, AttributeError):
+            pass
+        return {'status': 400, 'body': {'message': 'Bad request'}}
+
+    def _apply_changes(self, changed):
+        """Merge the states a service call reported as changed
+
+        Keeps the mirror exact until the next poll, which is also
+        triggered right away.
+        """
+        changed = [pruned for pruned in map(prune_state, changed or ())
+                   if pruned is not None]
+        if changed:
+            by_id = {state['entity_id']: state for state in changed}
+            with self._lock:
+                self.states = [by_id.pop(state['entity_id'], state)
+                               for state in self.states] + \
+                    list(by_id.values())
+                self.version += 1
+        self._refresh.set()
+
+    def _get(self, path):
+        now = monotonic()
+        with self._lock:
+            cached = self._get_cache.get(path)
+        if cached is not None and now - cached[0] < GET_TTL:
+            return cached[1]
+        reply = {'status': 200,
+                 'body': self.client._request('GET', path).json()}
+        with self._lock:
+            self._get_cache.pop(path, None)
+            self._get_cache[path] = (now, reply)
+            # drop expired replies and the oldest ones beyond the limit
+            while self._get_cache:
+                oldest = next(iter(self._get_cache.values()))[0]
+                if (now - oldest < GET_TTL and
+                        len(self._get_cache) <= GET_CACHE_SIZE):
+                    break
+                self._get_cache.popitem(last=False)
+        return reply
+
+    def start(self):
+        Thread(target=self._poll_loop, daemon=True).start()
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._refresh.set()
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _ProxyResponse(object):
+    """The parts of requests.Response the client and skill rely on"""
+
+    def __init__(self, status_code, body, url):
+        self.status_code = status_code
+        self.reason = ''
+        if isinstance(body, dict):
+            self.reason = body.get('message', '')
+        self.url = url
+        self._body = body
+
+    def json(self):
+        return self._body
+
+    def iter_content(self, chunk_size=1):
+        yield json.dumps(self._body).encode()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class HomeAssistantProxyClient(HomeAssistantClient):
+    """HomeAssistantClient talking to a HomeAssistantProxy
+
+    States are only transferred if they changed since the last fetch.
+    """
+
+    def __init__(self, proxy, token, cache_budget=None, lang=None):
+        host, _, port = proxy.rpartition(':')
+        if not host:
+            host, port = port, PROXY_PORT
+        kwargs = {'lang': lang}
+        if cache_budget is not None:
+            kwargs['cache_budget'] = cache_budget
+        super().__init__(host, token, int(port), **kwargs)
+        self.proxy = (host, int(port))
+        self.url = "proxy://{}:{}".format(host, port)
+        self.token = token
+        self._version = None
+        self._states = []
+        self._states_lock = Lock()
+
+    def _exchange(self, message, method, path):
+        request = Request(method, self.url + path)
+        message['token'] = self.token
+        try:
+            with socket.create_connection(self.proxy, TIMEOUT) as sock:
+                send_message(sock, message)
+                reply = recv_message(sock)
+        except socket.timeout:
+            raise Timeout(request=request)
+        except (OSError, EOFError, ValueError) as e:
+            raise ConnectionError(e, request=request)
+        r = _ProxyResponse(reply['status'], reply.get('body'), request.url)
+        if reply['status'] >= 400:
+            raise HTTPError(response=r, request=request)
+        return reply, r
+
+    def _request(self, method, path, data=None, stream=False):
+        if method == 'GET' and path == '/api/states':
+            with self._states_lock:
+                reply, r = self._exchange(
+                    {'op': 'states', 'since': self._version}, method, path)
+                if 'states' in reply:
+                    self._states = reply['states']
+                    self._version = reply['version']
+                r._body = self._states
+            return r
+        if method == 'GET':
+            return self._exchange({'op': 'get', 'path': path},
+                                  method, path)[1]
+        return self._exchange({'op': 'post', 'path': path, 'data': data},
+                              method, path)[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', required=True,
+                        help='host name or ip of the HA server')
+    parser.add_argument('--token', required=True,
+                        help='long-lived access token')
+    parser.add_argument('--port', type=int, default=8123,
+                        help='port of the HA server')
+    parser.add_argument('--ssl', action='store_true')
+    parser.add_argument('--no-verify', dest='verify', action='store_false')
+    parser.add_argument('--listen', default=':{}'.format(PROXY_PORT),
+                        help='address to serve on, [host]:port')
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL,
+                        help='seconds between two state downloads')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    host, _, port = args.listen.rpartition(':')
+    client = HomeAssistantClient(args.host, args.token, args.port,
+                                 args.ssl, args.verify)
+    proxy = HomeAssistantProxy(client, args.token,
+                               (host or '0.0.0.0', int(port)),
+                               args.interval)
+    proxy.start()
+    try:
+        proxy._stopped.wait()
+    except KeyboardInterrupt:
+        proxy.stop()
+
+
+if __name__ == '__main__':
+    main()
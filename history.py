@@ -0,0 +1,199 @@
+"""Streamed state history of single entities with aggregates"""
+import codecs
+import json
+import math
+from array import array
+from datetime import datetime
+from threading import Lock
+from time import monotonic
+
+try:
+    from .lazy import lazy_import
+except ImportError:
+    # imported outside of the skill package (unittests)
+    from lazy import lazy_import
+
+# optional, aggregates are computed in pure python without it, and only
+# loaded when first used
+np = lazy_import('numpy')
+
+
+# Seconds a downloaded history is reused without asking HA for news
+HISTORY_TTL = 60
+
+# Maximal number of (entity, window) pairs kept
+HISTORY_ENTRIES = 32
+
+# States that count as 'not on' for durations
+INACTIVE_STATES = ('off', 'unavailable', 'unknown', 'idle', 'standby', '')
+
+
+def iter_objects(chunks):
+    """Yield the objects of a (nested) JSON array while it downloads
+
+    Only one object is held as text at a time, so the response is never
+    loaded as a whole.
+
+    Arguments:
+        chunks  iterable of bytes, e.g. Response.iter_content()
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    for chunk in chunks:
+        buffer += text.decode(chunk)
+        position = 0
+        while True:
+            # skip array brackets, separators and whitespace
+            while position < len(buffer) and buffer[position] in '[], \t\r\n':
+                position += 1
+            if position == len(buffer):
+                break
+            try:
+                obj, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # incomplete object, wait for the next chunk
+                break
+            yield obj
+            position = end
+        buffer = buffer[position:]
+    if buffer.strip(' []\t\r\n,'):
+        raise ValueError('truncated history response')
+
+
+def parse_time(value):
+    """POSIX timestamp of an ISO 8601 time with offset, as sent by HA"""
+    value = value.replace('Z', '+00:00')
+    # strptime of python 3.6 takes the offset without a colon only
+    if len(value) > 6 and value[-6] in '+-' and value[-3] == ':':
+        value = value[:-3] + value[-2:]
+    if '.' in value:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f%z').timestamp()
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z').timestamp()
+
+
+class HistorySeries(object):
+    """State changes of one entity as flat arrays
+
+    times   POSIX timestamps of the changes
+    values  numeric state or NaN
+    active  1 if the state counts as on
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.times = array('d')
+        self.values = array('d')
+        self.active = array('b')
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def last(self):
+        return self.times[-1] if self.times else self.start
+
+    def extend(self, rows):
+        """Append history rows as delivered by HA, in order"""
+        for row in rows:
+            try:
+                changed = max(parse_time(row['last_changed']), self.start)
+            except (KeyError, ValueError):
+                continue
+            if self.times and changed < self.times[-1]:
+                continue
+            state = row.get('state', '')
+            try:
+                value = float(state)
+            except (TypeError, ValueError):
+                value = math.nan
+            self.times.append(changed)
+            self.values.append(value)
+            self.active.append(state not in INACTIVE_STATES)
+
+    def _durations(self, end):
+        """Seconds each state lasted until the next one (or end)"""
+        if np is not None:
+            times = np.frombuffer(self.times, dtype=float)
+            return np.diff(np.append(times, max(end, self.last)))
+        ends = list(self.times[1:]) + [max(end, self.last)]
+        return [e - s for s, e in zip(self.times, ends)]
+
+    def mean(self, end):
+        """Time-weighted mean of the numeric states, None if there is none"""
+        durations = self._durations(end)
+        if np is not None:
+            values = np.frombuffer(self.values, dtype=float)
+            mask = ~np.isnan(values)
+            if not mask.any():
+                return None
+            total = durations[mask].sum()
+            if total == 0:
+                return float(values[mask].mean())
+            return float((values[mask] * durations[mask]).sum() / total)
+        pairs = [(v, d) for v, d in zip(self.values, durations)
+                 if not math.isnan(v)]
+        if not pairs:
+            return None
+        total = sum(d for _, d in pairs)
+        if total == 0:
+            return sum(v for v, _ in pairs) / len(pairs)
+        return sum(v * d for v, d in pairs) / total
+
+    def minimum(self):
+        numeric = self._numeric()
+        return float(min(numeric)) if len(numeric) else None
+
+    def maximum(self):
+        numeric = self._numeric()
+        return float(max(numeric)) if len(numeric) else None
+
+    def _numeric(self):
+        if np is not None:
+            values = np.frombuffer(self.values, dtype=float)
+            return values[~np.isnan(values)]
+        return [v for v in self.values if not math.isnan(v)]
+
+    def on_duration(self, end):
+        """Seconds the entity was in an active state until end"""
+        durations = self._durations(end)
+        if np is not None:
+            active = np.frombuffer(self.active, dtype=np.int8).astype(bool)
+            return float(durations[active].sum())
+        return float(sum(d for d, a in zip(durations, self.active) if a))
+
+
+class HistoryCache(object):
+    """Histories per (entity, window start), extended incrementally
+
+    A repeated question within HISTORY_TTL is answered from memory.
+    Later only the changes since the last known one are downloaded.
+
+    Arguments:
+        fetch   function(entity_id, start) returning history rows
+    """
+
+    def __init__(self, fetch):
+        self._fetch = fetch
+        self._lock = Lock()
+        # (entity_id, start) -> (monotonic time of last fetch, series)
+        self._entries = {}
+
+    def get(self, entity_id, start):
+        key = (entity_id, start)
+        # history questions are rare, one download at a time is fine
+        with self._lock:
+            fetched, series = self._entries.get(key, (None, None))
+            if series is not None and monotonic() - fetched < HISTORY_TTL:
+                return series
+            if series is None:
+                series = HistorySeries(start)
+            # HA starts with the state at the given time, so asking from
+            # the last change on continues the series seamlessly
+            series.extend(self._fetch(entity_id, series.last))
+            self._entries[key] = (monotonic(), series)
+            # forget outdated windows, e.g. yesterday's 'today'
+            while len(self._entries) > HISTORY_ENTRIES:
+                oldest = min(self._entries, key=lambda k: k[1])
+                del self._entries[oldest]
+            return series
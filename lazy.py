@@ -0,0 +1,48 @@
+"""Modules imported on first use instead of at skill load"""
+import importlib
+import importlib.util
+import sys
+from threading import Lock
+
+
+class _LazyModule(object):
+    """Stand-in for a module, imported on first attribute access
+
+    The import runs under a lock, so handler threads touching the module
+    at the same time all get the completely loaded module.
+    importlib.util.LazyLoader is not safe for that before Python 3.12.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._module or self._load(), attr)
+
+    def __repr__(self):
+        return '<lazy module {!r}>'.format(self._name)
+
+
+def lazy_import(name):
+    """Return a module that is only imported on first attribute access
+
+    Returns None if the module is not installed, so optional modules can
+    be checked with `is None` as if they were imported eagerly.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        spec = None
+    if spec is None:
+        return None
+    return _LazyModule(name)
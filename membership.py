@@ -0,0 +1,252 @@
+"""Members of groups and areas with counts of the entities turned on"""
+from collections import Counter
+from threading import Lock
+
+try:
+    from .lazy import lazy_import
+except ImportError:
+    # imported outside of the skill package (unittests)
+    from lazy import lazy_import
+
+fuzz = lazy_import('fuzzywuzzy.fuzz')
+
+# Domains whose entities are counted as members, groups are expanded
+COUNTED_DOMAINS = ('light', 'fan', 'switch', 'input_boolean', 'climate')
+
+# States of counted entities that mean 'on', climate reports its mode
+ACTIVE_STATES = ('on', 'heat', 'cool', 'heat_cool', 'auto', 'dry',
+                 'fan_only')
+
+# Key of the container holding every counted entity
+HOUSE = None
+
+# Fuzzy score a spoken name needs to match a group or area, as for entities
+MIN_SCORE = 50
+
+
+def _domain(entity_id):
+    return entity_id.split(".")[0]
+
+
+def expand_groups(groups):
+    """Resolve nested groups to the entities they finally contain
+
+    Arguments:
+        groups  dict group entity_id -> member entity_ids
+    Return:
+        dict group entity_id -> frozenset of non-group entity_ids
+    """
+    expanded = {}
+    for group_id in groups:
+        members = set()
+        # groups listing each other, directly or not, must not loop
+        seen = {group_id}
+        pending = list(groups[group_id])
+        while pending:
+            member = pending.pop()
+            if _domain(member) != 'group':
+                members.add(member)
+            elif member not in seen:
+                seen.add(member)
+                pending.extend(groups.get(member, ()))
+        expanded[group_id] = frozenset(members)
+    return expanded
+
+
+class MembershipIndex(object):
+    """Which entities belong to which group or area, and how many are on
+
+    Memberships are rebuilt only when a group or area changes. State
+    changes adjust the per container counts of the affected entities,
+    so "is anything on in the kitchen" and "how many lights are on" are
+    answered without looking at the members.
+
+    Arguments:
+        normalize   callable bringing names in a comparable form
+    """
+
+    def __init__(self, normalize=None):
+        self._lock = Lock()
+        self.normalize = normalize or (lambda name: name.lower().strip())
+        # group entity_id -> raw member entity_ids, as reported by HA
+        self._groups = {}
+        # group entity_id -> friendly name
+        self._group_names = {}
+        # area name -> member entity_ids, as reported by HA
+        self._areas = {}
+        # normalized name -> container key
+        self._names = {}
+        # container key -> spoken name
+        self._labels = {}
+        # entity_id -> container keys it belongs to
+        self._containers = {}
+        # all counted entity_ids and the ones currently on
+        self._known = set()
+        self._active = set()
+        # container key -> Counter domain -> members / members on
+        self._sizes = {HOUSE: Counter()}
+        self._counts = {HOUSE: Counter()}
+
+    def update(self, states):
+        """Feed a complete state list, e.g. from /api/states"""
+        groups = {}
+        group_names = {}
+        counted = {}
+        for state in states:
+            entity_id = state['entity_id']
+            domain = _domain(entity_id)
+            if domain == 'group':
+                groups[entity_id] = tuple(
+                    state['attributes'].get('entity_id') or ())
+                group_names[entity_id] = state['attributes'].get(
+                    'friendly_name', entity_id)
+            elif domain in COUNTED_DOMAINS:
+                counted[entity_id] = state.get('state') in ACTIVE_STATES
+        with self._lock:
+            if (groups != self._groups or
+                    group_names != self._group_names or
+                    counted.keys() != self._known):
+                self._groups = groups
+                self._group_names = group_names
+                self._rebuild(counted, [entity_id for entity_id, active
+                                        in counted.items() if active])
+            else:
+                self._apply(states)
+
+    def apply(self, states):
+        """Feed changed states only, e.g. the answer of a service call"""
+        with self._lock:
+            self._apply(states)
+
+    def set_areas(self, areas):
+        """Set the areas of the HA registry, dict area name -> entity_ids
+
+        Return:
+            True if the areas changed
+        """
+        areas = {name: tuple(entity_ids)
+                 for name, entity_ids in areas.items()}
+        with self._lock:
+            if areas == self._areas:
+                return False
+            self._areas = areas
+            self._rebuild(self._known, self._active)
+            return True
+
+    def find(self, name):
+        """Key of the group or area called name, None if unknown
+
+        Names that don't match exactly are matched fuzzily, like
+        entity names.
+        """
+        phrase = self.normalize(name)
+        names = self._names
+        if phrase in names:
+            return names[phrase]
+        best_score = MIN_SCORE
+        best_key = None
+        for form, key in names.items():
+            score = fuzz.ratio(phrase, form)
+            if score > best_score:
+                best_score = score
+                best_key = key
+        return best_key
+
+    def names(self):
+        """Spoken names of all groups and areas"""
+        with self._lock:
+            return list(self._labels.values())
+
+    def label(self, key):
+        """Spoken name of a container"""
+        return self._labels.get(key)
+
+    def active(self, key=HOUSE, domain=None):
+        """Number of members turned on, of a domain if given"""
+        with self._lock:
+            counts = self._counts.get(key, Counter())
+            if domain is None:
+                return sum(counts.values())
+            return counts[domain]
+
+    def size(self, key=HOUSE, domain=None):
+        """Number of counted members, of a domain if given"""
+        with self._lock:
+            sizes = self._sizes.get(key, Counter())
+            if domain is None:
+                return sum(sizes.values())
+            return sizes[domain]
+
+    def _rebuild(self, known, active):
+        """Recompute memberships and counts from scratch
+
+        Must be called with the lock held.
+
+        Arguments:
+            known   entity_ids of all counted entities at HA
+            active  the ones of them turned on
+        """
+        members = dict(expand_groups(self._groups))
+        labels = dict(self._group_names)
+        for area, entity_ids in self._areas.items():
+            key = 'area:' + area
+            labels[key] = area
+            # groups assigned to an area bring their members
+            members[key] = frozenset(
+                member for entity_id in entity_ids
+                for member in (members.get(entity_id, ())
+                               if _domain(entity_id) == 'group'
+                               else (entity_id,)))
+        containers = {}
+        for key, entity_ids in members.items():
+            for entity_id in entity_ids:
+                if _domain(entity_id) in COUNTED_DOMAINS:
+                    containers.setdefault(entity_id, []).append(key)
+        names = {}
+        # groups are configured on purpose, they win over equal areas
+        for key in sorted(labels, key=lambda key: key.startswith('group.')):
+            names[self.normalize(labels[key])] = key
+        self._names = names
+        self._labels = labels
+        self._containers = containers
+        self._known = set(known)
+        self._active = set(active) & self._known
+        self._sizes = {key: Counter() for key in labels}
+        self._counts = {key: Counter() for key in labels}
+        self._sizes[HOUSE] = Counter()
+        self._counts[HOUSE] = Counter()
+        for entity_id in self._known:
+            domain = _domain(entity_id)
+            for key in self._keys(entity_id):
+                self._sizes[key][domain] += 1
+                if entity_id in self._active:
+                    self._counts[key][domain] += 1
+
+    def _keys(self, entity_id):
+        return [HOUSE] + self._containers.get(entity_id, [])
+
+    def _apply(self, states):
+        """Adjust the counts of the entities whose state changed
+
+        Must be called with the lock held.
+        """
+        for state in states:
+            entity_id = state['entity_id']
+            domain = _domain(entity_id)
+            if domain not in COUNTED_DOMAINS:
+                continue
+            if entity_id not in self._known:
+                # added at HA since the last full update
+                self._known.add(entity_id)
+                for key in self._keys(entity_id):
+                    self._sizes[key][domain] += 1
+            active = state.get('state') in ACTIVE_STATES
+            if active == (entity_id in self._active):
+                continue
+            step = 1 if active else -1
+            if active:
+                self._active.add(entity_id)
+            else:
+                self._active.discard(entity_id)
+            for key in self._keys(entity_id):
+                self._counts[key][domain] += step
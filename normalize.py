@@ -0,0 +1,176 @@
+"""Language-aware normalization of entity names and spoken phrases"""
+import re
+import unicodedata
+from functools import lru_cache
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+# Articles, possessives and fillers that carry no part of a name
+STOPWORDS = {
+    'en': ('the', 'a', 'an', 'my', 'our', 'in', 'of', 'on', 'at', 'please',
+           'all'),
+    'de': ('der', 'die', 'das', 'den', 'dem', 'des', 'ein', 'eine', 'einen',
+           'einem', 'einer', 'mein', 'meine', 'meinen', 'im', 'in', 'am',
+           'vom', 'von', 'bitte', 'alle'),
+    'nl': ('de', 'het', 'een', 'mijn', 'onze', 'in', 'van', 'op', 'aan',
+           'alsjeblieft', 'alle'),
+    'sv': ('en', 'ett', 'den', 'det', 'de', 'min', 'mitt', 'mina', 'i',
+           'på', 'av', 'tack', 'alla'),
+    'da': ('en', 'et', 'den', 'det', 'de', 'min', 'mit', 'mine', 'i', 'på',
+           'af', 'tak', 'alle'),
+    'fr': ('le', 'la', 'les', 'l', 'un', 'une', 'des', 'du', 'de', 'd',
+           'mon', 'ma', 'mes', 'dans', 'au', 'aux', 'stp', 'tous', 'toutes'),
+    'es': ('el', 'la', 'los', 'las', 'un', 'una', 'unos', 'unas', 'del',
+           'de', 'mi', 'mis', 'en', 'al', 'todos', 'todas'),
+    'it': ('il', 'lo', 'la', 'i', 'gli', 'le', 'l', 'un', 'uno', 'una',
+           'del', 'della', 'di', 'mio', 'mia', 'nel', 'nella', 'in', 'tutti',
+           'tutte'),
+    'pt': ('o', 'a', 'os', 'as', 'um', 'uma', 'do', 'da', 'dos', 'das',
+           'de', 'meu', 'minha', 'no', 'na', 'em', 'todos', 'todas'),
+    'ca': ('el', 'la', 'els', 'les', 'l', 'un', 'una', 'del', 'de', 'd',
+           'meu', 'meva', 'al', 'a', 'en', 'tots', 'totes'),
+    'gl': ('o', 'a', 'os', 'as', 'un', 'unha', 'do', 'da', 'de', 'meu',
+           'miña', 'no', 'na', 'en', 'todos', 'todas'),
+    'pl': ('w', 'we', 'na', 'z', 'mój', 'moja', 'moje', 'proszę',
+           'wszystkie'),
+    'cs': ('v', 've', 'na', 'z', 'můj', 'moje', 'prosím', 'všechna',
+           'všechny')
+}
+
+# Linking elements between the parts of a compound, for languages that
+# write compounds as one word
+LINKING = {
+    'de': ('', 's', 'n', 'en', 'e', 'es', 'er'),
+    'nl': ('', 's', 'e', 'en'),
+    'sv': ('', 's', 'e', 'a', 'o', 'u'),
+    'da': ('', 's', 'e')
+}
+
+# Common compound parts, besides the words of the entity names
+COMPOUND_PARTS = {
+    'de': ('licht', 'lampe', 'leuchte', 'decke', 'steckdose', 'schalter',
+           'heizung', 'thermostat', 'sensor', 'temperatur', 'fenster',
+           'tuer', 'zimmer', 'kueche', 'bad', 'flur', 'garten', 'garage',
+           'keller', 'wohn', 'schlaf', 'kinder', 'arbeits', 'ventilator'),
+    'nl': ('licht', 'lamp', 'plafond', 'stopcontact', 'schakelaar',
+           'verwarming', 'thermostaat', 'sensor', 'temperatuur', 'raam',
+           'deur', 'kamer', 'keuken', 'badkamer', 'gang', 'tuin', 'garage',
+           'kelder', 'woon', 'slaap', 'kinder', 'werk', 'ventilator'),
+    'sv': ('ljus', 'lampa', 'lampan', 'tak', 'uttag', 'brytare', 'element',
+           'termostat', 'sensor', 'temperatur', 'fonster', 'dorr', 'rum',
+           'kok', 'kokets', 'badrum', 'hall', 'tradgard', 'garage',
+           'kallare', 'vardags', 'sov', 'barn', 'arbets', 'flakt'),
+    'da': ('lys', 'lampe', 'loft', 'stikkontakt', 'kontakt', 'varme',
+           'termostat', 'sensor', 'temperatur', 'vindue', 'dor', 'rum',
+           'stue', 'kokken', 'koekken', 'bad', 'gang', 'have', 'garage',
+           'kaelder', 'sove', 'born', 'arbejds', 'ventilator')
+}
+
+# Parts shorter than this are not split off, 'bad' is the shortest room
+MIN_PART = 3
+
+# Decompositions of spoken words kept per normalizer
+SPLIT_CACHE = 1024
+
+# Letters not decomposed by NFKD
+_SPECIAL = {'ß': 'ss', 'æ': 'ae', 'ø': 'o', 'œ': 'oe', 'ł': 'l'}
+
+# Umlauts spelled out in words like 'Kueche', matching 'Küche'
+_SPELLED = {'ä': 'ae', 'ö': 'oe', 'ü': 'ue'}
+
+
+def fold(text, spell_umlauts=False):
+    """Lower case text without diacritics
+
+    With spell_umlauts German umlauts become 'ae', 'oe' and 'ue' instead
+    of losing their dots.
+    """
+    text = text.lower()
+    if spell_umlauts:
+        for letter, spelled in _SPELLED.items():
+            text = text.replace(letter, spelled)
+    for letter, replacement in _SPECIAL.items():
+        text = text.replace(letter, replacement)
+    return ''.join(char for char in unicodedata.normalize('NFKD', text)
+                   if not unicodedata.combining(char))
+
+
+class Normalizer(object):
+    """Brings names and spoken phrases into a comparable form
+
+    Text is folded to lower case without diacritics and stopwords are
+    dropped. In de, nl, sv and da compounds are split into the words of
+    the known names ('Küchenlicht' -> 'kueche licht'). The remaining
+    words are sorted, so the result can be compared with a plain ratio
+    instead of fuzz.token_sort_ratio.
+
+    Arguments:
+        lang    language code like 'de-de', defaults to English
+    """
+
+    def __init__(self, lang=None):
+        self.lang = (lang or 'en-us').split('-')[0].lower()
+        self._umlauts = self.lang == 'de'
+        self.stopwords = frozenset(
+            fold(word, self._umlauts)
+            for word in STOPWORDS.get(self.lang, ()))
+        self.linking = LINKING.get(self.lang)
+        self.vocabulary = frozenset(COMPOUND_PARTS.get(self.lang, ()))
+        self._splits = lru_cache(maxsize=SPLIT_CACHE)(self._decompose)
+
+    def learn(self, names):
+        """Use the words of the given names as compound parts"""
+        if self.linking is None:
+            return
+        vocabulary = set(COMPOUND_PARTS.get(self.lang, ()))
+        for name in names:
+            vocabulary.update(token for token in
+                              _TOKEN.findall(fold(name, self._umlauts))
+                              if len(token) >= MIN_PART)
+        self.vocabulary = frozenset(vocabulary)
+        self._splits = lru_cache(maxsize=SPLIT_CACHE)(self._decompose)
+
+    def split(self, token):
+        """Split a compound into its smallest known words, if it is one
+
+        Known words are split as well, so the name 'Wohnzimmer Lampe'
+        and the spoken 'Wohnzimmerlampe' both become 'wohn zimmer lampe'.
+        """
+        if self.linking is None or len(token) < 2 * MIN_PART:
+            return (token,)
+        return self._splits(token)
+
+    def _decompose(self, token):
+        return self._split(token, {}) or (token,)
+
+    def _split(self, token, parts):
+        """Decomposition with the most known words, None if there is none
+
+        parts memoizes the decompositions of the tails of one token.
+        """
+        if token in parts:
+            return parts[token]
+        best = (token,) if token in self.vocabulary else None
+        for end in range(MIN_PART, len(token) - MIN_PART + 1):
+            head = token[:end]
+            if head not in self.vocabulary:
+                continue
+            for link in self.linking:
+                if not token.startswith(link, end):
+                    continue
+                tail = self._split(token[end + len(link):], parts)
+                if tail and (best is None or len(tail) + 1 > len(best)):
+                    best = (head,) + tail
+        parts[token] = best
+        return best
+
+    def __call__(self, text):
+        tokens = _TOKEN.findall(fold(text, self._umlauts))
+        last = len(tokens) - 1
+        # a trailing letter tells 'Lamp A' from 'Lamp B', it's no article
+        words = [word for position, token in enumerate(tokens)
+                 if token not in self.stopwords or
+                 (position == last and len(token) == 1)
+                 for word in self.split(token)]
+        # a name made of stopwords only is still a name
+        return ' '.join(sorted(words or tokens))
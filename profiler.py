@@ -0,0 +1,72 @@
+"""Sampled profiles of intent handlers, aggregated per handler"""
+import cProfile
+import os
+import pstats
+import random
+from os.path import join
+from threading import Lock
+
+
+# Profiled calls aggregated into one file before it is rotated
+SAMPLES_PER_FILE = 20
+
+# Rotated files kept per handler, besides the current one
+PROFILE_FILES = 5
+
+
+class HandlerProfiler(object):
+    """Profiles a fraction of the calls with cProfile
+
+    The profiles of each handler are summed up in <handler>.prof in the
+    given directory, readable with pstats or snakeviz. After
+    SAMPLES_PER_FILE calls the file is rotated to <handler>.prof.1 and so
+    on.
+
+    cProfile can only watch one call at a time; calls coming in while
+    one is profiled run unprofiled.
+
+    Arguments:
+        directory   where the profiles are written to
+        fraction    share of the calls to profile, 0 to 1
+    """
+
+    def __init__(self, directory, fraction):
+        self.directory = directory
+        self.fraction = fraction
+        os.makedirs(directory, exist_ok=True)
+        self._active = Lock()
+        self._lock = Lock()
+        # handler name -> (pstats.Stats, number of samples)
+        self._stats = {}
+
+    def run(self, name, function, *args, **kwargs):
+        if (random.random() >= self.fraction or
+                not self._active.acquire(blocking=False)):
+            return function(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            self._active.release()
+            self._add(name, profile)
+
+    def _add(self, name, profile):
+        path = join(self.directory, name + '.prof')
+        with self._lock:
+            stats, samples = self._stats.get(name, (None, 0))
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            samples += 1
+            stats.dump_stats(path)
+            if samples < SAMPLES_PER_FILE:
+                self._stats[name] = (stats, samples)
+                return
+            # start a new file, the aggregate so far is complete
+            del self._stats[name]
+            for number in range(PROFILE_FILES - 1, 0, -1):
+                older = '{}.{}'.format(path, number)
+                if os.path.exists(older):
+                    os.replace(older, '{}.{}'.format(path, number + 1))
+            os.replace(path, path + '.1')
@@ -0,0 +1,304 @@
+import sys
+from threading import RLock
+from time import monotonic
+
+try:
+    from .normalize import Normalizer
+except ImportError:
+    # imported outside of the skill package (unittests)
+    from normalize import Normalizer
+
+
+# Domains the skill resolves entities in; everything else is dropped
+RELEVANT_DOMAINS = (
+    'group',
+    'light',
+    'fan',
+    'switch',
+    'scene',
+    'input_boolean',
+    'climate',
+    'cover',
+    'sensor',
+    'binary_sensor',
+    'automation',
+    'script',
+    'device_tracker',
+    'person',
+    'zone'
+)
+
+# Attributes read by the skill, per domain ('*' applies to every domain)
+RELEVANT_ATTRIBUTES = {
+    '*': ('friendly_name', 'unit_of_measurement'),
+    'group': ('entity_id',),
+    'light': ('brightness',),
+    'sensor': ('device_class',),
+    'binary_sensor': ('device_class',),
+    'device_tracker': ('latitude', 'longitude'),
+    'person': ('latitude', 'longitude'),
+    'zone': ('latitude', 'longitude', 'radius')
+}
+
+# Default memory budget of the state cache in bytes
+DEFAULT_BUDGET = 512 * 1024
+
+# Seconds a cached state snapshot is considered fresh
+DEFAULT_TTL = 2
+
+# Seconds without a query after which a domain is evicted
+DEFAULT_IDLE = 15 * 60
+
+
+def _deep_size(obj):
+    """Approximate the memory footprint of a pruned state.
+
+    Only handles the types produced by prune_state (dicts, tuples, lists
+    and scalars), which keeps the estimate cheap.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += _deep_size(key) + _deep_size(value)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += _deep_size(item)
+    return size
+
+
+def prune_state(state):
+    """Reduce a raw HA state object to the fields the skill reads.
+
+    Returns None for states of irrelevant domains.
+    """
+    entity_id = state['entity_id']
+    domain = entity_id.split(".")[0]
+    if domain not in RELEVANT_DOMAINS:
+        return None
+    keep = RELEVANT_ATTRIBUTES['*'] + RELEVANT_ATTRIBUTES.get(domain, ())
+    attributes = state.get('attributes', {})
+    return {
+        'entity_id': entity_id,
+        'state': state.get('state'),
+        'attributes': {key: attributes[key] for key in keep
+                       if key in attributes}
+    }
+
+
+class StateCache(object):
+    """Domain-scoped mirror of the HA state list.
+
+    States are pruned to RELEVANT_DOMAINS and RELEVANT_ATTRIBUTES on
+    update. The cached states and their normalized forms stay within the
+    byte budget: domains are evicted least recently queried first, and
+    domains that have not been queried for `idle` seconds are dropped on
+    every update. The index of friendly names and the vocabulary of the
+    normalizer are not counted, they hold one short entry per entity
+    and are kept for all domains.
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET, ttl=DEFAULT_TTL,
+                 idle=DEFAULT_IDLE, normalizer=None):
+        self.budget = budget
+        self.ttl = ttl
+        self.idle = idle
+        self._lock = RLock()
+        # domain -> {entity_id: pruned state}
+        self._domains = {}
+        # domain -> approximate size in bytes
+        self._sizes = {}
+        # domain -> monotonic time of the last query
+        self._queried = {}
+        # domain -> monotonic time the domain was first seen at HA
+        self._seen = {}
+        # domains present at HA but dropped from the mirror
+        self._evicted = set()
+        self._updated = None
+        # bumped by invalidate, a fetch started before is never fresh
+        self.generation = 0
+        # lower case friendly name -> entity ids, over all relevant domains
+        self._names = {}
+        # bumped whenever the set of friendly names changes
+        self.names_version = 0
+        self.normalizer = normalizer or Normalizer()
+        # domain -> {entity_id: normalized (friendly name, entity id)},
+        # filled by the first scan, kept until the names change
+        self._forms = {}
+        # domain -> approximate size of its normalized forms in bytes
+        self._form_sizes = {}
+
+    def size(self):
+        """Approximate number of bytes of the cached states and forms."""
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def resize(self, budget):
+        """Change the memory budget, evicting domains right away"""
+        with self._lock:
+            self.budget = budget
+            self._evict(monotonic())
+
+    def domains(self):
+        with self._lock:
+            return list(self._domains)
+
+    def is_fresh(self, domains):
+        """Check if all requested domains are cached and not outdated."""
+        with self._lock:
+            if self._updated is None:
+                return False
+            if monotonic() - self._updated > self.ttl:
+                return False
+            return not any(domain in self._evicted for domain in domains)
+
+    def invalidate(self):
+        """Force the next lookup to fetch fresh states."""
+        with self._lock:
+            self._updated = None
+            self.generation += 1
+
+    def touch(self, domains):
+        """Record a query for the given domains."""
+        now = monotonic()
+        with self._lock:
+            for domain in domains:
+                self._queried[domain] = now
+
+    def get(self, domains):
+        """Return cached states of the given domains as a list."""
+        self.touch(domains)
+        with self._lock:
+            states = []
+            for domain in domains:
+                states.extend(self._domains.get(domain, {}).values())
+            return states
+
+    def get_entity(self, entity_id):
+        """Return the cached state of a single entity or None."""
+        domain = entity_id.split(".")[0]
+        self.touch([domain])
+        with self._lock:
+            return self._domains.get(domain, {}).get(entity_id)
+
+    def names(self):
+        """Friendly names of all entities in relevant domains."""
+        with self._lock:
+            return sorted(self._names)
+
+    def lookup(self, name, domains):
+        """Resolve an exact friendly name or entity id to an entity id.
+
+        Returns None if the name is unknown or ambiguous within domains.
+        """
+        name = name.lower().strip()
+        if name.split(".")[0] in domains and "." in name:
+            return name
+        with self._lock:
+            entity_ids = [entity_id for entity_id in self._names.get(name, ())
+                          if entity_id.split(".")[0] in domains]
+        if len(entity_ids) == 1:
+            return entity_ids[0]
+        return None
+
+    def normalize(self, text):
+        """Normalized form of a spoken phrase, see Normalizer"""
+        return self.normalizer(text)
+
+    def forms(self, entity_id, name=None):
+        """Normalized friendly name and entity id of an entity
+
+        Computed once and kept with the cached domain, so repeated scans
+        do no string processing.
+        """
+        domain = entity_id.split(".")[0]
+        forms = self._forms.get(domain, {}).get(entity_id)
+        if forms is not None:
+            return forms
+        id_form = self.normalize(entity_id.replace('_', ' '))
+        forms = (self.normalize(name) if name else id_form), id_form
+        with self._lock:
+            if domain in self._domains:
+                self._forms.setdefault(domain, {})[entity_id] = forms
+                size = _deep_size(entity_id) + _deep_size(forms)
+                self._form_sizes[domain] = (
+                    self._form_sizes.get(domain, 0) + size)
+                self._sizes[domain] += size
+        return forms
+
+    def update(self, states, generation=None):
+        """Replace the mirror with a fresh HA state list.
+
+        If generation is given and the cache was invalidated since, the
+        states are stored but not considered fresh.
+
+        Returns the pruned states of all relevant domains, including
+        domains that are not retained afterwards.
+        """
+        domains = {}
+        for state in states:
+            try:
+                pruned = prune_state(state)
+            except (KeyError, AttributeError):
+                continue
+            if pruned is not None:
+                domain = pruned['entity_id'].split(".")[0]
+                domains.setdefault(domain, {})[pruned['entity_id']] = pruned
+        sizes = {domain: _deep_size(entities)
+                 for domain, entities in domains.items()}
+        names = {}
+        for entities in domains.values():
+            for entity_id, pruned in entities.items():
+                name = pruned['attributes'].get('friendly_name')
+                if name:
+                    names.setdefault(name.lower(), []).append(entity_id)
+        names_changed = names != self._names
+        if names_changed:
+            # new words to split compounds into
+            self.normalizer.learn(names)
+
+        now = monotonic()
+        with self._lock:
+            for domain in domains:
+                # a domain that was never queried starts its idle period now
+                self._seen.setdefault(domain, now)
+            self._domains = domains
+            if names_changed:
+                self._forms = {}
+                self._form_sizes = {}
+            for domain, size in self._form_sizes.items():
+                if domain in sizes:
+                    sizes[domain] += size
+            self._sizes = sizes
+            self._evicted = set()
+            if generation is None or generation == self.generation:
+                self._updated = now
+            if names.keys() != self._names.keys():
+                self.names_version += 1
+            self._names = names
+            self._evict(now)
+
+        return [pruned for entities in domains.values()
+                for pruned in entities.values()]
+
+    def _evict(self, now):
+        """Drop idle domains, then least recently queried until in budget.
+
+        Must be called with the lock held.
+        """
+        for domain in list(self._domains):
+            last_used = self._queried.get(domain, self._seen[domain])
+            if now - last_used > self.idle:
+                self._drop(domain)
+
+        # domains that were never queried go first
+        by_age = sorted(self._domains,
+                        key=lambda d: self._queried.get(d, float('-inf')))
+        while by_age and sum(self._sizes.values()) > self.budget:
+            self._drop(by_age.pop(0))
+
+    def _drop(self, domain):
+        self._domains.pop(domain, None)
+        self._sizes.pop(domain, None)
+        self._forms.pop(domain, None)
+        self._form_sizes.pop(domain, None)
+        self._evicted.add(domain)
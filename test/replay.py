@@ -0,0 +1,185 @@
+"""Record and replay Home Assistant REST traffic for the intent tests
+
+A recording is a JSON file with the answers of the HA server:
+
+    {
+      "states": [...],                      # GET /api/states
+      "components": ["light", ...],         # GET /api/components
+      "responses": {"POST /api/services/light/turn_on": [...], ...},
+      "budget": {"requests": 2, "bytes": 4096, "seconds": 1.0}
+    }
+
+Requests without a recorded answer get an empty list (services) or a
+404. The budget limits what one intent test may cost; seconds are the
+time the server spent answering, not the time the intent took.
+
+Record a snapshot of a real server:
+    python test/replay.py --host 192.168.1.2 --token TOKEN out.json
+"""
+import argparse
+import json
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import monotonic
+
+# Limits of an intent test without a budget in its recording
+DEFAULT_BUDGET = {'requests': 3, 'bytes': 16 * 1024, 'seconds': 2.0}
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        # counted before the client can see the answer, a reset() right
+        # after a request must not miss it
+        self.server.replay.record(self.command, self.path, len(data),
+                                  monotonic() - self._started)
+        self.wfile.write(data)
+
+    def _answer(self):
+        self._started = monotonic()
+        replay = self.server.replay
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if self.headers.get('Authorization') != 'Bearer ' + replay.token:
+            return self._reply(401, {'message': 'Unauthorized'})
+        key = '{} {}'.format(self.command, self.path)
+        if key in replay.responses:
+            return self._reply(200, replay.responses[key])
+        if self.path == '/api/':
+            return self._reply(200, {'message': 'API running.'})
+        if self.path == '/api/states':
+            return self._reply(200, replay.states)
+        if self.path == '/api/components':
+            return self._reply(200, replay.components)
+        if self.command == 'POST' and self.path.startswith('/api/services/'):
+            # HA answers with the changed states, none are recorded
+            return self._reply(200, [])
+        self._reply(404, {'message': 'Not found'})
+
+    do_GET = _answer
+    do_POST = _answer
+
+
+class ReplayServer(object):
+    """Local stand-in for HA answering from a recording
+
+    Counts the requests and bytes sent, use as context manager.
+    """
+
+    def __init__(self, recording, token='token'):
+        self.states = recording.get('states', [])
+        self.components = recording.get('components', ['conversation'])
+        self.responses = recording.get('responses', {})
+        self.budget = dict(DEFAULT_BUDGET, **recording.get('budget', {}))
+        self.token = token
+        self.requests = Counter()
+        self.bytes_sent = 0
+        # time spent answering requests
+        self.seconds = 0.0
+        self._lock = Lock()
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.replay = self
+
+    @classmethod
+    def load(cls, path, token='token'):
+        with open(path) as f:
+            return cls(json.load(f), token)
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def record(self, method, path, size, seconds):
+        with self._lock:
+            self.requests[method, path] += 1
+            self.bytes_sent += size
+            self.seconds += seconds
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.bytes_sent = 0
+            self.seconds = 0.0
+
+    def over_budget(self):
+        """Descriptions of the exceeded limits, empty if within budget"""
+        exceeded = []
+        requests = sum(self.requests.values())
+        if requests > self.budget['requests']:
+            exceeded.append('{} requests, budget {}: {}'.format(
+                requests, self.budget['requests'], dict(self.requests)))
+        if self.bytes_sent > self.budget['bytes']:
+            exceeded.append('{} bytes, budget {}'.format(
+                self.bytes_sent, self.budget['bytes']))
+        if self.seconds > self.budget['seconds']:
+            exceeded.append('{:.2f} s, budget {} s'.format(
+                self.seconds, self.budget['seconds']))
+        return exceeded
+
+    def start(self):
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def record(url, token, verify=True):
+    """Snapshot the answers of a real HA server as a recording"""
+    from requests import Session
+    session = Session()
+    session.headers['Authorization'] = 'Bearer {}'.format(token)
+    recording = {}
+    for key, path in (('states', '/api/states'),
+                      ('components', '/api/components')):
+        r = session.get(url + path, verify=verify, timeout=10)
+        r.raise_for_status()
+        recording[key] = r.json()
+    return recording
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', required=True,
+                        help='host name or ip of the HA server')
+    parser.add_argument('--token', required=True,
+                        help='long-lived access token')
+    parser.add_argument('--port', type=int, default=8123,
+                        help='port of the HA server')
+    parser.add_argument('--ssl', action='store_true')
+    parser.add_argument('output', help='recording file to write')
+    args = parser.parse_args()
+    url = '{}://{}:{}'.format('https' if args.ssl else 'http',
+                              args.host, args.port)
+    with open(args.output, 'w') as f:
+        json.dump(record(url, args.token), f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
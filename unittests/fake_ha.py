@@ -0,0 +1,179 @@
+"""Minimal Home Assistant REST API stand-in for tests on localhost"""
+import json
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from history import parse_time
+
+# Seconds of history HA returns when no end_time is given
+HISTORY_PERIOD = 24 * 60 * 60
+
+
+def light(name, state='off', brightness=None):
+    entity_id = 'light.' + name.lower().replace(' ', '_')
+    attributes = {'friendly_name': name, 'supported_features': 151}
+    if brightness is not None:
+        attributes['brightness'] = brightness
+    return {'entity_id': entity_id, 'state': state, 'attributes': attributes}
+
+
+DEFAULT_STATES = [
+    light('Kitchen Lights', 'on', 128),
+    light('Bedroom Lights'),
+    light('Office Lights'),
+    {'entity_id': 'sensor.outside_temperature', 'state': '21.5',
+     'attributes': {'friendly_name': 'Outside Temperature',
+                    'unit_of_measurement': '°C'}},
+    {'entity_id': 'media_player.tv', 'state': 'off',
+     'attributes': {'friendly_name': 'TV'}}
+]
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.ha.record(self.command, self.path, len(data))
+
+    def do_GET(self):
+        ha = self.server.ha
+        sleep(ha.delay)
+        if self.headers.get('Authorization') != 'Bearer ' + ha.token:
+            self._reply(401, {'message': 'Unauthorized'})
+        elif self.path == '/api/':
+            self._reply(200, {'message': 'API running.'})
+        elif self.path == '/api/states':
+            self._reply(200, ha.get_states())
+        elif self.path == '/api/components':
+            self._reply(200, ha.components)
+        elif self.path.startswith('/api/history/period/'):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query, keep_blank_values=True)
+            start = parse_time(unquote(url.path.split('/')[-1]))
+            if 'end_time' in query:
+                end = parse_time(query['end_time'][0])
+            else:
+                end = start + HISTORY_PERIOD
+            entity_id = query['filter_entity_id'][0]
+            self._reply(200, [ha.get_history(entity_id, start, end)])
+        else:
+            self._reply(404, {'message': 'Not found'})
+
+    def do_POST(self):
+        ha = self.server.ha
+        sleep(ha.delay)
+        length = int(self.headers.get('Content-Length') or 0)
+        data = json.loads(self.rfile.read(length) or b'{}')
+        parts = self.path.split('/')
+        if self.headers.get('Authorization') != 'Bearer ' + ha.token:
+            self._reply(401, {'message': 'Unauthorized'})
+        elif self.path.startswith('/api/services/') and len(parts) == 5:
+            self._reply(200, ha.call_service(parts[3], parts[4], data))
+        elif self.path == '/api/template':
+            # only the area template is rendered
+            if ha.areas is None:
+                self._reply(400, {'message': 'Error rendering template'})
+            else:
+                self._reply(200, [[name, entity_ids] for name, entity_ids
+                                  in sorted(ha.areas.items())])
+        elif self.path == '/api/conversation/process':
+            self._reply(200, {'speech': {'plain': {
+                'speech': "Sorry, I didn't understand that"}}})
+        else:
+            self._reply(404, {'message': 'Not found'})
+
+
+class FakeHomeAssistant(object):
+    """Serves a fixed state list and applies turn_on/turn_off services
+
+    Use as context manager; `url` is the base url of the running server.
+    """
+
+    def __init__(self, states=None, token='token', delay=0):
+        self.states = [dict(state) for state in (states or DEFAULT_STATES)]
+        self.token = token
+        self.delay = delay
+        self.components = ['light', 'conversation']
+        # area name -> entity_ids, None for a HA without areas
+        self.areas = None
+        # entity_id -> history rows with 'state' and 'last_changed'
+        self.history = {}
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self.services = []
+        self._lock = Lock()
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.ha = self
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    def record(self, method, path, size):
+        with self._lock:
+            self.requests[method, path] += 1
+            self.bytes_sent += size
+
+    def get_states(self):
+        with self._lock:
+            return list(self.states)
+
+    def get_history(self, entity_id, start, end):
+        return [row for row in self.history.get(entity_id, ())
+                if start <= parse_time(row['last_changed']) <= end]
+
+    def call_service(self, domain, service, data):
+        entity_ids = data.get('entity_id', [])
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        changed = []
+        with self._lock:
+            self.services.append((domain, service, data))
+            new_state = {'turn_on': 'on', 'turn_off': 'off'}.get(service)
+            for i, state in enumerate(self.states):
+                matches = (state['entity_id'] in entity_ids or
+                           (entity_ids == ['all'] and
+                            state['entity_id'].startswith(domain + '.')))
+                if new_state and matches:
+                    state = dict(state, state=new_state)
+                    self.states[i] = state
+                    changed.append(state)
+        return changed
+
+    def start(self):
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,181 @@
+from unittest import TestCase
+import sys
+import tempfile
+import unittest
+from os.path import dirname, join
+from unittest import mock
+sys.path.append(join(dirname(__file__), '..'))
+import command_queue
+from command_queue import CommandQueue, CommandQueued, batches, queueable
+from ha_client import HomeAssistantClient
+from fake_ha import FakeHomeAssistant
+
+
+def turn(action, entity_id, **data):
+    return ('homeassistant', 'turn_' + action,
+            dict(data, entity_id=entity_id))
+
+
+class TestBatches(TestCase):
+
+    def test_superseded_collapsed(self):
+        commands = [turn('on', 'light.a'), turn('on', 'light.b'),
+                    turn('off', 'light.a')]
+        self.assertEqual(batches(commands), [
+            turn('on', 'light.b'), turn('off', 'light.a')])
+
+    def test_superseded_only_by_same_keys(self):
+        commands = [turn('on', 'light.a', brightness=10),
+                    turn('on', 'light.a')]
+        self.assertEqual(batches(commands), commands)
+        self.assertEqual(batches(commands[::-1]), [commands[0]])
+        self.assertEqual(batches(commands + [turn('off', 'light.a')]),
+                         [turn('off', 'light.a')])
+
+    def test_merged_into_one_call(self):
+        commands = [turn('off', 'light.a'), turn('off', 'light.b'),
+                    turn('on', 'light.c', brightness=10),
+                    turn('off', 'light.d')]
+        self.assertEqual(batches(commands), [
+            turn('off', ['light.a', 'light.b', 'light.d']),
+            turn('on', 'light.c', brightness=10)])
+
+    def test_order_per_entity_kept(self):
+        commands = [turn('on', 'climate.a'),
+                    ('climate', 'set_temperature',
+                     {'entity_id': 'climate.a', 'temperature': 20}),
+                    turn('on', 'climate.b')]
+        # merging climate.b would be fine, but not moving climate.a
+        result = batches(commands)
+        self.assertEqual(result[0], turn('on', ['climate.a', 'climate.b']))
+        self.assertEqual(batches(commands + [turn('off', 'climate.a')])[-1],
+                         turn('off', 'climate.a'))
+
+    def test_not_merged_across_all(self):
+        commands = [turn('off', 'light.a'),
+                    ('light', 'turn_on', {'entity_id': 'all'}),
+                    turn('off', 'light.b')]
+        self.assertEqual(batches(commands), commands)
+        # a switch is not part of all lights
+        commands[2] = turn('off', 'switch.b')
+        self.assertEqual(batches(commands), [
+            turn('off', ['light.a', 'switch.b']),
+            ('light', 'turn_on', {'entity_id': 'all'})])
+
+    def test_queueable(self):
+        self.assertTrue(queueable('light', 'turn_on',
+                                  {'entity_id': 'light.a'}))
+        self.assertFalse(queueable('homeassistant', 'toggle',
+                                   {'entity_id': 'light.a'}))
+        self.assertFalse(queueable('homeassistant', 'turn_on',
+                                   {'entity_id': 'script.wake_up'}))
+        self.assertFalse(queueable('light', 'turn_on',
+                                   {'entity_id': 'light.a',
+                                    'brightness_step_pct': 10}))
+
+
+class TestCommandQueue(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = join(self.directory.name, 'queue.jsonl')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_survives_restart(self):
+        CommandQueue(self.path).add(*turn('on', 'light.a'))
+        with open(self.path, 'a') as f:
+            # cut off by a crash
+            f.write('{"time": 1')
+        self.assertEqual(CommandQueue(self.path).pending(),
+                         [turn('on', 'light.a')])
+
+    def test_length_kept_in_memory(self):
+        queue = CommandQueue(self.path)
+        queue.add(*turn('on', 'light.a'))
+        queue.add(*turn('off', 'light.b'))
+        with mock.patch('builtins.open', side_effect=AssertionError):
+            self.assertEqual(len(queue), 2)
+        self.assertEqual(len(CommandQueue(self.path)), 2)
+        queue.replay(lambda *args: None)
+        self.assertEqual(len(queue), 0)
+
+    def test_expired_dropped(self):
+        queue = CommandQueue(self.path, ttl=60)
+        queue.add(*turn('on', 'light.a'))
+        with mock.patch.object(command_queue, 'time',
+                               return_value=command_queue.time() + 61):
+            self.assertEqual(len(queue), 0)
+
+    def test_partial_replay(self):
+        queue = CommandQueue(self.path)
+        queue.add(*turn('on', 'light.a', brightness=5))
+        queue.add(*turn('off', 'light.b'))
+        sent = []
+
+        def execute(domain, service, data):
+            if sent:
+                raise command_queue.ConnectionError()
+            sent.append(data)
+
+        self.assertEqual(queue.replay(execute), 1)
+        self.assertEqual(queue.pending(), [turn('off', 'light.b')])
+        self.assertEqual(queue.replay(lambda *args: None), 1)
+        self.assertEqual(queue.pending(), [])
+
+
+class TestClientQueue(TestCase):
+
+    def test_queued_while_away_and_replayed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            queue = CommandQueue(join(directory, 'queue.jsonl'))
+            with FakeHomeAssistant() as ha:
+                client = HomeAssistantClient(ha.host, ha.token, ha.port)
+                client.queue = queue
+                client.find_entity('kitchen lights', ['light'])
+
+            # HA is gone, names still resolve from the last known states
+            entity = client.find_entity('bedroom lights', ['light'])
+            for action in ('on', 'off', 'on'):
+                with self.assertRaises(CommandQueued):
+                    client.execute_service('homeassistant',
+                                           'turn_' + action,
+                                           {'entity_id': entity['id']})
+            with self.assertRaises(CommandQueued):
+                client.execute_service('homeassistant', 'turn_off',
+                                       {'entity_id': 'light.office_lights'})
+            # every command tried to send the queue first, which collapsed
+            # it on the way
+            self.assertEqual(len(queue), 2)
+
+            with FakeHomeAssistant() as ha:
+                client.url = ha.url
+                self.assertEqual(client.replay_queue(), 2)
+                self.assertEqual(len(queue), 0)
+                self.assertEqual(ha.services, [
+                    ('homeassistant', 'turn_on',
+                     {'entity_id': 'light.bedroom_lights'}),
+                    ('homeassistant', 'turn_off',
+                     {'entity_id': 'light.office_lights'})])
+                self.assertTrue(client.connected())
+
+    def test_queue_sent_before_next_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            queue = CommandQueue(join(directory, 'queue.jsonl'))
+            queue.add(*turn('on', 'light.bedroom_lights'))
+            with FakeHomeAssistant() as ha:
+                client = HomeAssistantClient(ha.host, ha.token, ha.port)
+                client.queue = queue
+                # HA is back, the command goes out after the queued one
+                r = client.execute_service(
+                    *turn('off', 'light.office_lights'))
+                self.assertEqual(r.status_code, 200)
+                self.assertEqual(len(queue), 0)
+                self.assertEqual(ha.services, [
+                    turn('on', 'light.bedroom_lights'),
+                    turn('off', 'light.office_lights')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+from unittest import TestCase
+import importlib.util
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from os.path import dirname, join
+from threading import Event
+from time import sleep
+from unittest import mock
+sys.path.append(join(dirname(__file__), '..'))
+from ha_client import HomeAssistantClient, SingleFlight
+from fake_ha import FakeHomeAssistant
+
+THREADS = 16
+ROUNDS = 20
+
+
+def load_skill():
+    """Import the skill package, requires mycroft-core"""
+    root = join(dirname(__file__), '..')
+    spec = importlib.util.spec_from_file_location(
+        'homeassistant_skill', join(root, '__init__.py'),
+        submodule_search_locations=[root])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestSingleFlight(TestCase):
+
+    def test_concurrent_calls_coalesced(self):
+        flight = SingleFlight()
+        calls = []
+        started = Event()
+
+        def slow():
+            calls.append(1)
+            started.set()
+            sleep(0.2)
+            return object()
+
+        with ThreadPoolExecutor(8) as pool:
+            first = pool.submit(flight.do, 'key', slow)
+            started.wait()
+            others = [pool.submit(flight.do, 'key', slow) for _ in range(7)]
+            results = [first.result()] + [f.result() for f in others]
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(r is results[0] for r in results))
+
+    def test_error_shared(self):
+        flight = SingleFlight()
+        with self.assertRaises(ValueError):
+            flight.do('key', int, 'not a number')
+        # the failed call is not remembered
+        self.assertEqual(flight.do('key', int, '1'), 1)
+
+
+class TestClientStress(TestCase):
+
+    def test_find_execute_and_setup(self):
+        with FakeHomeAssistant(delay=0.01) as ha:
+            shared = {'client': HomeAssistantClient(ha.host, ha.token,
+                                                    ha.port)}
+            found = []
+
+            def force_setup():
+                # what the skill's _force_setup does: build, swap, connect
+                client = HomeAssistantClient(ha.host, ha.token, ha.port)
+                shared['client'] = client
+                return client.connected()
+
+            def worker(n):
+                for i in range(ROUNDS):
+                    client = shared['client']
+                    if (n + i) % 10 == 0:
+                        self.assertTrue(force_setup())
+                    elif (n + i) % 5 == 0:
+                        client.execute_service('homeassistant', 'turn_on',
+                                               {'entity_id':
+                                                'light.office_lights'})
+                    else:
+                        entity = client.find_entity('kitchen lights',
+                                                    ['light'])
+                        found.append(entity['id'])
+
+            with ThreadPoolExecutor(THREADS) as pool:
+                for future in [pool.submit(worker, n)
+                               for n in range(THREADS)]:
+                    future.result()
+
+        self.assertEqual(set(found), {'light.kitchen_lights'})
+        fetches = ha.requests['GET', '/api/states']
+        # far fewer downloads than lookups
+        self.assertLess(fetches, len(found))
+
+
+class TestSkillStress(TestCase):
+
+    def setUp(self):
+        try:
+            self.skill_module = load_skill()
+        except ImportError as e:
+            self.skipTest('mycroft-core not available: {}'.format(e))
+
+    def test_handlers_during_force_setup(self):
+        with FakeHomeAssistant(delay=0.01) as ha:
+            skill = self.skill_module.create_skill()
+            skill.settings = {'host': ha.host, 'token': ha.token,
+                              'portnum': ha.port}
+            skill.speak_dialog = mock.MagicMock()
+            skill._setup()
+
+            def worker(n):
+                for i in range(ROUNDS):
+                    if (n + i) % 10 == 0:
+                        skill._force_setup()
+                    elif (n + i) % 5 == 0:
+                        skill.ha.execute_service(
+                            'homeassistant', 'turn_on',
+                            {'entity_id': 'light.office_lights'})
+                    else:
+                        entity = skill._find_entity('kitchen lights',
+                                                    ['light'])
+                        self.assertEqual(entity['id'],
+                                         'light.kitchen_lights')
+
+            with ThreadPoolExecutor(THREADS) as pool:
+                for future in [pool.submit(worker, n)
+                               for n in range(THREADS)]:
+                    future.result()
+        # no handler ran into an error dialog
+        skill.speak_dialog.assert_not_called()
+
+    def test_settings_change_applied_in_place(self):
+        with FakeHomeAssistant() as ha:
+            skill = self.skill_module.create_skill()
+            skill.settings = {'host': ha.host, 'token': ha.token,
+                              'portnum': ha.port, 'enable_fallback': False}
+            skill._setup()
+            client = skill.ha
+            fetches = ha.requests['GET', '/api/states']
+
+            skill.settings['enable_fallback'] = True
+            skill.settings['cache_budget'] = 64
+            skill.on_websettings_changed()
+            self.assertIs(skill.ha, client)
+            self.assertTrue(skill.enable_fallback)
+            self.assertEqual(client.cache.budget, 64 * 1024)
+            self.assertEqual(ha.requests['GET', '/api/states'], fetches)
+
+            skill.settings['token'] = 'other'
+            skill.on_websettings_changed()
+            self.assertIsNot(skill.ha, client)
+
+    def test_lookups_during_swap(self):
+        with FakeHomeAssistant(delay=0.05) as ha:
+            skill = self.skill_module.create_skill()
+            skill.settings = {'host': ha.host, 'token': ha.token,
+                              'portnum': ha.port}
+            skill.speak_dialog = mock.MagicMock()
+            skill._setup()
+
+            def lookup(n):
+                entity = skill._find_entity('kitchen lights', ['light'])
+                self.assertEqual(entity['id'], 'light.kitchen_lights')
+
+            with ThreadPoolExecutor(THREADS) as pool:
+                futures = [pool.submit(lookup, n) for n in range(THREADS)]
+                skill.settings['portnum'] = str(ha.port)
+                skill.on_websettings_changed()
+                futures += [pool.submit(lookup, n) for n in range(THREADS)]
+                for future in futures:
+                    future.result()
+        skill.speak_dialog.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
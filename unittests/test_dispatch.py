@@ -0,0 +1,148 @@
+from unittest import TestCase
+import sys
+import unittest
+from os.path import dirname, join
+from threading import Event, Lock
+from time import monotonic, sleep
+sys.path.append(join(dirname(__file__), '..'))
+from dispatch import DispatchScheduler, Ticket
+from ha_client import HomeAssistantClient
+from fake_ha import FakeHomeAssistant, light
+
+
+class Recorder(object):
+    """send callable recording the calls with their time"""
+
+    def __init__(self):
+        self.calls = []
+        self._lock = Lock()
+
+    def __call__(self, domain, service, data):
+        with self._lock:
+            self.calls.append((monotonic(), domain, service,
+                               data['entity_id']))
+
+
+def lights(count):
+    return ['light.light_{}'.format(i) for i in range(count)]
+
+
+class TestDispatchScheduler(TestCase):
+
+    def test_bulk_paced(self):
+        send = Recorder()
+        dispatcher = DispatchScheduler(send, rate=50)
+        start = monotonic()
+        ticket = dispatcher.bulk('light', 'turn_off', {}, lights(20))
+        self.assertTrue(ticket.wait(5))
+        elapsed = monotonic() - start
+        self.assertEqual(ticket.sent, 20)
+        # two at once, the rest one per 20 ms
+        self.assertGreater(elapsed, 18 / 50 * 0.9)
+        self.assertLess(elapsed, 20 / 50 * 3)
+        self.assertEqual([call[3] for call in send.calls], lights(20))
+
+    def test_domains_paced_separately(self):
+        send = Recorder()
+        dispatcher = DispatchScheduler(send, rate=20)
+        ticket = dispatcher.bulk('homeassistant', 'turn_off', {},
+                                 lights(4) + ['climate.hall'])
+        self.assertTrue(ticket.wait(5))
+        # the thermostat doesn't wait for the lights
+        self.assertEqual(send.calls[1][3], 'climate.hall')
+
+    def test_duplicates_merged(self):
+        send = Recorder()
+        dispatcher = DispatchScheduler(send, rate=10)
+        first = dispatcher.bulk('light', 'turn_on', {}, lights(10))
+        second = dispatcher.bulk('light', 'turn_off', {}, lights(10))
+        self.assertTrue(second.wait(5))
+        self.assertTrue(first.done())
+        self.assertEqual(first.sent + first.dropped, 10)
+        self.assertGreater(first.dropped, 0)
+        # every light got exactly one turn_off as its last call
+        last = {}
+        for _, _, service, entity_id in send.calls:
+            last[entity_id] = service
+        self.assertEqual(set(last.values()), {'turn_off'})
+        self.assertEqual(len(send.calls), first.sent + 10)
+
+    def test_interactive_ahead_of_bulk(self):
+        send = Recorder()
+        dispatcher = DispatchScheduler(send, rate=5)
+        ticket = dispatcher.bulk('light', 'turn_off', {}, lights(10))
+        sleep(0.1)
+        start = monotonic()
+        dispatcher.interactive('light', 'turn_on',
+                               {'entity_id': 'light.light_9'})
+        # at most the next token, not behind the queued lights
+        self.assertLess(monotonic() - start, 1 / 5 + 0.05)
+        self.assertEqual(send.calls[-1][2], 'turn_on')
+        # the queued call would undo the newer command, it is dropped
+        self.assertEqual(ticket.dropped, 1)
+        dispatcher.cancel()
+        self.assertTrue(ticket.done())
+
+    def test_interactive_paced_back_to_back(self):
+        send = Recorder()
+        dispatcher = DispatchScheduler(send, rate=10)
+        start = monotonic()
+        for entity_id in lights(5):
+            dispatcher.interactive('light', 'turn_on',
+                                   {'entity_id': entity_id})
+        # the burst goes out right away, then one per 100 ms
+        self.assertLess(send.calls[1][0] - start, 0.05)
+        self.assertGreater(monotonic() - start, 0.3 * 0.9)
+
+    def test_errors_tracked(self):
+        def send(domain, service, data):
+            if data['entity_id'] == 'light.light_1':
+                raise ValueError()
+        failed = []
+        ticket = DispatchScheduler(
+            send, rate=100,
+            on_error=lambda *call: failed.append(call)).bulk(
+                'light', 'turn_off', {}, lights(3))
+        self.assertTrue(ticket.wait(5))
+        self.assertEqual((ticket.sent, len(ticket.errors)), (2, 1))
+        self.assertEqual(failed[0][2], {'entity_id': 'light.light_1'})
+
+    def test_empty_ticket_done(self):
+        self.assertTrue(Ticket(0).done())
+
+
+class TestClientPacing(TestCase):
+
+    def test_all_off_split(self):
+        states = [light('Light {}'.format(i), 'on' if i % 2 else 'off')
+                  for i in range(10)]
+        with FakeHomeAssistant(states) as ha:
+            client = HomeAssistantClient(ha.host, ha.token, ha.port)
+            client.pace(100)
+            ticket = client.execute_service('light', 'turn_off',
+                                            {'entity_id': 'all'})
+            self.assertTrue(ticket.wait(5))
+            # lights already off are skipped
+            self.assertEqual(ticket.total, 5)
+            self.assertTrue(all(state['state'] == 'off'
+                                for state in ha.get_states()))
+            # a single light is sent right away, as before
+            response = client.execute_service(
+                'light', 'turn_on', {'entity_id': 'light.light_0'})
+            self.assertEqual(response.status_code, 200)
+            client.pace(None)
+            self.assertIsNone(client.dispatcher)
+
+    def test_all_of_unknown_domain_sent_as_is(self):
+        with FakeHomeAssistant() as ha:
+            client = HomeAssistantClient(ha.host, ha.token, ha.port)
+            client.pace(100)
+            response = client.execute_service(
+                'cover', 'close_cover', {'entity_id': 'all'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(ha.services[-1],
+                             ('cover', 'close_cover', {'entity_id': 'all'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
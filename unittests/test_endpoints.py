@@ -0,0 +1,115 @@
+from unittest import TestCase
+import socket
+import sys
+import unittest
+from os.path import dirname, join
+from time import monotonic
+sys.path.append(join(dirname(__file__), '..'))
+import endpoints
+from ha_client import HomeAssistantClient
+from fake_ha import FakeHomeAssistant
+
+
+def closed_url():
+    """Url of a local port nobody listens on"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+
+
+class TestEndpoints(TestCase):
+
+    def setUp(self):
+        self.fast = FakeHomeAssistant().start()
+        self.slow = FakeHomeAssistant(delay=0.5).start()
+
+    def tearDown(self):
+        self.fast.stop()
+        self.slow.stop()
+
+    def client(self, *urls):
+        primary = urls[0].split('//')[1]
+        host, port = primary.split(':')
+        return HomeAssistantClient(host, 'token', int(port),
+                                   urls=list(urls[1:]))
+
+    def test_fastest_url_wins(self):
+        ha = self.client(self.slow.url, self.fast.url)
+        ha.find_entity('kitchen lights', ['light'])
+        self.assertEqual(ha.endpoints.ranked()[0].url, self.fast.url)
+        self.assertEqual(self.fast.requests['GET', '/api/states'], 1)
+        self.assertEqual(self.slow.requests['GET', '/api/states'], 0)
+
+    def test_unreachable_url_skipped(self):
+        ha = self.client(closed_url(), self.fast.url)
+        self.assertTrue(ha.connected())
+        r = ha.execute_service('homeassistant', 'turn_on',
+                               {'entity_id': 'light.office_lights'})
+        self.assertEqual(r.status_code, 200)
+
+    def test_post_fails_over_when_not_sent(self):
+        other = FakeHomeAssistant(delay=0.1).start()
+        self.addCleanup(other.stop)
+        ha = self.client(self.fast.url, other.url)
+        ha.endpoints.ranked()
+        # the primary goes away, the service call must go out once
+        self.fast.stop()
+        self.fast = FakeHomeAssistant().start()
+        ha.execute_service('homeassistant', 'turn_on',
+                           {'entity_id': 'light.office_lights'})
+        self.assertEqual(len(other.services), 1)
+
+    def test_slow_primary_hedged(self):
+        ha = self.client(self.fast.url, self.slow.url)
+        ha.endpoints.ranked()
+        for _ in range(endpoints.MIN_SAMPLES):
+            ha._get_state()
+        # the primary turns slow, the runner-up answers first
+        self.fast.delay = 2
+        hedged = self.slow.requests['GET', '/api/states']
+        start = monotonic()
+        ha._get_state()
+        self.assertLess(monotonic() - start, 1.5)
+        self.assertEqual(self.slow.requests['GET', '/api/states'],
+                         hedged + 1)
+
+    def test_kinds_sampled_apart(self):
+        ha = self.client(self.fast.url, self.slow.url)
+        ha.endpoints.ranked()
+        for _ in range(endpoints.MIN_SAMPLES):
+            ha._get_state()
+        primary = ha.endpoints.ranked()[0]
+        self.assertIn('/api/states', primary.samples)
+        # unseen kinds hedge after the default delay, not the states' p95
+        self.assertEqual(primary.hedge_delay('/api/history'),
+                         endpoints.DEFAULT_HEDGE_DELAY)
+
+    def test_race_backs_off_while_down(self):
+        ha = self.client(closed_url(), closed_url())
+        for _ in range(3):
+            self.assertFalse(ha.connected())
+        # only the first request waited for a race
+        probed = ha.endpoints._probed
+        ha.endpoints.ranked()
+        self.assertEqual(ha.endpoints._probed, probed)
+
+    def test_closed_during_request(self):
+        ha = self.client(self.fast.url, self.slow.url)
+        ha.endpoints.ranked()
+        # close() of another thread lands between the check and submit
+        ha.endpoints._pool.shutdown()
+        self.assertTrue(ha.connected())
+
+    def test_closed_client_still_answers(self):
+        ha = self.client(self.slow.url, self.fast.url)
+        ha.endpoints.ranked()
+        ha.close()
+        self.assertTrue(ha.endpoints._pool._shutdown)
+        # handlers in flight keep working, without the thread pool
+        self.assertEqual(ha.find_entity('kitchen lights', ['light'])['id'],
+                         'light.kitchen_lights')
+        self.assertEqual(self.slow.requests['GET', '/api/states'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+from unittest import TestCase
+import sys
+import tempfile
+import unittest
+from os.path import dirname, join
+sys.path.append(join(dirname(__file__), '..'))
+from entity_vocab import EntityVocabulary
+from ha_client import HomeAssistantClient
+from fake_ha import FakeHomeAssistant, light
+
+
+class TestEntityVocabulary(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self, vocab):
+        with open(vocab.path) as f:
+            return f.read().splitlines()
+
+    def test_file_written(self):
+        vocab = EntityVocabulary(self.directory.name, 'en-us')
+        self.assertTrue(vocab.update(['Kitchen Lights', 'TV']))
+        self.assertEqual(vocab.path, join(self.directory.name, 'en-us',
+                                          'entity.entity'))
+        self.assertEqual(self.read(vocab), ['kitchen lights', 'tv'])
+        # names survive a restart of the skill
+        self.assertEqual(EntityVocabulary(self.directory.name,
+                                          'en-us').names,
+                         {'kitchen lights', 'tv'})
+
+    def test_names_deduplicated(self):
+        vocab = EntityVocabulary(self.directory.name, 'en-us')
+        vocab.update(['TV', 'tv ', 'Tv', '  '])
+        self.assertEqual(self.read(vocab), ['tv'])
+
+    def test_rewritten_only_when_changed(self):
+        vocab = EntityVocabulary(self.directory.name, 'en-us')
+        self.assertTrue(vocab.update(['TV']))
+        self.assertFalse(vocab.update(['tv']))
+        self.assertTrue(vocab.update(['TV', 'Radio']))
+
+
+class TestNamesListener(TestCase):
+
+    def test_called_when_names_change(self):
+        with FakeHomeAssistant() as ha:
+            client = HomeAssistantClient(ha.host, ha.token, ha.port)
+            calls = []
+            client.names_listener = calls.append
+            client._get_state()
+            # a state change keeps the names
+            client.execute_service('homeassistant', 'turn_on',
+                                   {'entity_id': 'light.office_lights'})
+            client._get_state()
+            self.assertEqual(len(calls), 1)
+            self.assertIn('kitchen lights', calls[0])
+
+            ha.states.append(light('Porch'))
+            client.cache.invalidate()
+            client._get_state()
+            self.assertEqual(len(calls), 2)
+            self.assertIn('porch', calls[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
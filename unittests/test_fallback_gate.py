@@ -0,0 +1,42 @@
+from unittest import TestCase
+import sys
+import unittest
+from os.path import dirname, join
+sys.path.append(join(dirname(__file__), '..'))
+from fallback_gate import FallbackGate
+
+
+class TestFallbackGate(TestCase):
+
+    def setUp(self):
+        self.gate = FallbackGate(['turn', 'lights', 'open'])
+        self.gate.update(['Living Room Lamp', 'Garage Door'])
+
+    def test_open_without_names(self):
+        self.assertTrue(FallbackGate().check("what's the capital of France"))
+
+    def test_decisions(self):
+        self.assertTrue(self.gate.check('dim the living room'))
+        self.assertTrue(self.gate.check('is the garage closed'))
+        self.assertTrue(self.gate.check('turn off all lights'))
+        self.assertFalse(self.gate.check("what's the capital of France"))
+        self.assertFalse(self.gate.check('open a new document'))
+
+    def test_area_names(self):
+        self.assertFalse(self.gate.check('is anything on in the attic'))
+        self.gate.update_areas(['Attic'])
+        self.assertTrue(self.gate.check('is anything on in the attic'))
+        # new entity names keep the areas
+        self.gate.update(['Garage Door'])
+        self.assertTrue(self.gate.check('is anything on in the attic'))
+
+    def test_precision(self):
+        self.gate.record('capital of France', False)
+        self.gate.record('garage', True, True)
+        self.gate.record('living room', True, False)
+        self.assertEqual(self.gate.stats(), {'blocked': 1, 'forwarded': 2,
+                                             'precision': 0.5})
+
+
+if __name__ == '__main__':
+    unittest.main()
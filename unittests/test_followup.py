@@ -0,0 +1,69 @@
+from unittest import TestCase
+import sys
+import unittest
+from os.path import dirname, join
+from unittest import mock
+sys.path.append(join(dirname(__file__), '..'))
+import followup
+from followup import FollowUpContext
+from fake_ha import FakeHomeAssistant
+from test_concurrency import load_skill
+
+
+class TestFollowUpContext(TestCase):
+
+    def test_per_session(self):
+        context = FollowUpContext()
+        context.remember('kitchen', 'light.kitchen', 'Kitchen Light')
+        context.remember('office', 'all', 'all lights', 'light')
+        self.assertEqual(context.recall('kitchen')['id'], 'light.kitchen')
+        self.assertEqual(context.recall('office')['domain'], 'light')
+        self.assertIsNone(context.recall('bedroom'))
+
+    def test_expiry(self):
+        context = FollowUpContext(ttl=60)
+        with mock.patch.object(followup, 'monotonic', return_value=100):
+            context.remember('', 'light.hall', 'Hall')
+        with mock.patch.object(followup, 'monotonic', return_value=150):
+            self.assertEqual(context.recall('')['dev_name'], 'Hall')
+        with mock.patch.object(followup, 'monotonic', return_value=161):
+            self.assertIsNone(context.recall(''))
+
+    def test_size(self):
+        context = FollowUpContext(size=2)
+        for session in ('a', 'b', 'c'):
+            context.remember(session, 'light.' + session, session)
+        self.assertIsNone(context.recall('a'))
+        self.assertIsNotNone(context.recall('c'))
+
+
+class TestFollowUpIntents(TestCase):
+
+    def setUp(self):
+        try:
+            self.skill_module = load_skill()
+        except ImportError as e:
+            self.skipTest('mycroft-core not available: {}'.format(e))
+
+    def test_no_lookup(self):
+        with FakeHomeAssistant() as ha:
+            skill = self.skill_module.create_skill()
+            skill.settings = {'host': ha.host, 'token': ha.token,
+                              'portnum': ha.port}
+            skill.speak_dialog = mock.MagicMock()
+            skill._setup()
+            message = mock.MagicMock(data={}, context={'source': 'kitchen'})
+            skill._remember(message, 'light.kitchen_lights', 'Kitchen Lights')
+            ha.requests.clear()
+            skill.handle_followup_dimmer_intent(message)
+        self.assertEqual(list(ha.requests),
+                         [('POST', '/api/services/homeassistant/turn_on')])
+        self.assertEqual(ha.services[-1][2],
+                         {'entity_id': 'light.kitchen_lights',
+                          'brightness_step_pct': -10})
+        skill.speak_dialog.assert_called_with(
+            'homeassistant.followup.dimmer', data=mock.ANY)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+from unittest import TestCase
+import sys
+import unittest
+from os.path import dirname, join
+from unittest import mock
+sys.path.append(join(dirname(__file__), '..'))
+import geo
+from geo import ProximityIndex, haversine_matrix
+
+
+def place(entity_id, lat, lon, radius=None):
+    attributes = {'friendly_name': entity_id.split('.')[1].title(),
+                  'latitude': lat, 'longitude': lon}
+    if radius is not None:
+        attributes['radius'] = radius
+    return {'entity_id': entity_id, 'state': 'home',
+            'attributes': attributes}
+
+
+STATES = [
+    place('zone.home', 52.3731, 4.8922, 100),
+    place('zone.office', 52.3080, 4.7621, 150),
+    place('person.alice', 52.3733, 4.8925),
+    place('person.bob', 52.3090, 4.7630),
+    place('device_tracker.alice_phone', 52.3733, 4.8925),
+    {'entity_id': 'device_tracker.router', 'state': 'home',
+     'attributes': {'friendly_name': 'Router'}}
+]
+
+
+class TestGeo(TestCase):
+
+    def test_haversine(self):
+        # Paris - London
+        matrix = haversine_matrix([48.8566, 51.5074], [2.3522, -0.1278])
+        self.assertAlmostEqual(matrix[0][1] / 1000, 343.5, delta=0.5)
+        self.assertEqual(matrix[0][0], 0)
+
+    def test_haversine_without_numpy(self):
+        lats, lons = [48.8566, 51.5074, 52.3731], [2.3522, -0.1278, 4.8922]
+        expected = haversine_matrix(lats, lons)
+        with mock.patch.object(geo, 'np', None):
+            matrix = haversine_matrix(lats, lons)
+        for i in range(3):
+            for j in range(3):
+                self.assertAlmostEqual(matrix[i][j], expected[i][j], 3)
+
+    def test_ranked_and_near(self):
+        index = ProximityIndex()
+        index.update(STATES)
+        ranked = index.ranked('zone.home')
+        self.assertEqual([entity_id for entity_id, _ in ranked],
+                         ['person.alice', 'person.bob'])
+        self.assertEqual([entity_id for entity_id, _ in
+                          index.near('zone.office')], ['person.bob'])
+        self.assertAlmostEqual(index.distance('person.alice', 'zone.office'),
+                               11600, delta=200)
+        self.assertIsNone(index.distance('device_tracker.router',
+                                         'zone.home'))
+
+    def test_distances_cached_until_position_changes(self):
+        index = ProximityIndex()
+        index.update(STATES)
+        matrix = index._distances()[0]
+        index.update(STATES)
+        self.assertIs(index._distances()[0], matrix)
+        index.update(STATES[:-2] + [place('device_tracker.alice_phone',
+                                          52.3, 4.8)])
+        self.assertIsNot(index._distances()[0], matrix)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+from unittest import TestCase
+import sys
+import unittest
+from time import sleep
+from os.path import dirname, join
+from unittest import mock
+from requests.exceptions import HTTPError
+sys.path.append(join(dirname(__file__), '..'))
+from ha_client import HomeAssistantClient
+import ha_proxy
+from ha_proxy import HomeAssistantProxy, HomeAssistantProxyClient
+from fake_ha import FakeHomeAssistant
+
+DEVICES = 6
+UTTERANCES = 10
+
+
+class TestHomeAssistantProxy(TestCase):
+
+    def setUp(self):
+        self.ha = FakeHomeAssistant().start()
+        client = HomeAssistantClient(self.ha.host, self.ha.token,
+                                     self.ha.port)
+        self.proxy = HomeAssistantProxy(client, self.ha.token,
+                                        ('127.0.0.1', 0), interval=60)
+        self.proxy.start()
+        # wait for the first poll
+        while self.proxy.version == 0:
+            sleep(0.01)
+        self.address = '{}:{}'.format(*self.proxy.address)
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.ha.stop()
+
+    def device(self, token=None):
+        return HomeAssistantProxyClient(self.address,
+                                        token or self.ha.token)
+
+    def test_ha_load_independent_of_devices(self):
+        devices = [self.device() for _ in range(DEVICES)]
+        polls = self.ha.requests['GET', '/api/states']
+        for _ in range(UTTERANCES):
+            for device in devices:
+                device.cache.invalidate()
+                entity = device.find_entity('kitchen lights', ['light'])
+                self.assertEqual(entity['id'], 'light.kitchen_lights')
+        self.assertEqual(self.ha.requests['GET', '/api/states'], polls)
+
+    def test_states_only_sent_when_changed(self):
+        device = self.device()
+        device._get_state()
+        version = device._version
+        device._get_state()
+        self.assertEqual(device._version, version)
+
+    def test_service_forwarded_and_mirrored(self):
+        device = self.device()
+        self.assertEqual(
+            device.find_entity('bedroom lights', ['light'])['state'], 'off')
+        r = device.execute_service('homeassistant', 'turn_on',
+                                   {'entity_id': 'light.bedroom_lights'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.ha.services[-1][1], 'turn_on')
+        # the mirror is updated before the next poll
+        self.assertEqual(
+            device.find_entity('bedroom lights', ['light'])['state'], 'on')
+
+    def test_get_forwarded(self):
+        device = self.device()
+        self.assertTrue(device.find_component('conversation'))
+        self.assertTrue(device.find_component('light'))
+        self.assertEqual(self.ha.requests['GET', '/api/components'], 1)
+
+    def test_membership(self):
+        self.ha.areas = {'Kitchen': ['light.kitchen_lights']}
+        index = self.device().membership()
+        self.assertEqual(index.active(index.find('kitchen')), 1)
+
+    def test_get_cache_bounded(self):
+        reply = mock.MagicMock()
+        reply.json.return_value = []
+        with mock.patch.object(ha_proxy, 'GET_CACHE_SIZE', 3), \
+                mock.patch.object(self.proxy.client, '_request',
+                                  return_value=reply):
+            for i in range(10):
+                self.proxy._get('/api/components?{}'.format(i))
+        self.assertEqual(list(self.proxy._get_cache),
+                         ['/api/components?{}'.format(i) for i in (7, 8, 9)])
+
+    def test_bad_requests_answered(self):
+        self.assertEqual(self.proxy.handle({'token': 'tökén'})['status'],
+                         401)
+        self.assertEqual(self.proxy.handle(['states'])['status'], 400)
+        self.assertEqual(self.proxy.handle(
+            {'token': self.ha.token, 'op': 'get'})['status'], 400)
+        reply = mock.MagicMock()
+        reply.json.side_effect = ValueError('no JSON')
+        with mock.patch.object(self.proxy.client, '_request',
+                               return_value=reply):
+            self.assertEqual(self.proxy.handle(
+                {'token': self.ha.token, 'op': 'post',
+                 'path': '/api/template', 'data': {}})['status'], 502)
+
+    def test_idle_proxy_stops_polling(self):
+        self.proxy.interval = 0.01
+        with mock.patch.object(ha_proxy, 'IDLE_AFTER', 0.05):
+            sleep(0.2)
+            polls = self.ha.requests['GET', '/api/states']
+            sleep(0.2)
+            self.assertEqual(self.ha.requests['GET', '/api/states'], polls)
+            # a device asking gets fresh states and wakes the poller
+            self.ha.states[1] = dict(self.ha.states[1], state='on')
+            device = self.device()
+            self.assertEqual(
+                device.find_entity('bedroom lights', ['light'])['state'],
+                'on')
+            for _ in range(100):
+                if self.ha.requests['GET', '/api/states'] > polls + 1:
+                    break
+                sleep(0.01)
+            self.assertGreater(self.ha.requests['GET', '/api/states'],
+                               polls + 1)
+
+    def test_invalid_poll_logged(self):
+        with mock.patch.object(self.proxy.client, '_get_state',
+                               side_effect=ValueError('not JSON')), \
+                mock.patch.object(ha_proxy.LOG, 'warning') as warning:
+            self.proxy._try_poll()
+        warning.assert_called_once()
+
+    def test_wrong_token(self):
+        with self.assertRaises(HTTPError) as error:
+            self.device('wrong').find_entity('kitchen lights', ['light'])
+        self.assertEqual(error.exception.response.status_code, 401)
+
+
+if __name__ == '__main__':
+    unittest.main()
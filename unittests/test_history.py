@@ -0,0 +1,109 @@
+from unittest import TestCase
+import json
+import sys
+import unittest
+from datetime import datetime, timezone
+from os.path import dirname, join
+from time import time
+from unittest import mock
+sys.path.append(join(dirname(__file__), '..'))
+import history
+from history import HistoryCache, HistorySeries, iter_objects, parse_time
+from ha_client import HomeAssistantClient
+from fake_ha import FakeHomeAssistant
+
+DAY = 24 * 60 * 60
+
+START = 1560000000.0
+
+
+def row(offset, state):
+    return {'state': state,
+            'last_changed': '2019-06-08T13:{:02d}:00+00:00'.format(offset)}
+
+
+ROWS = [row(20, '20.0'), row(30, '22.0'), row(40, 'unavailable'),
+        row(50, '18.0')]
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestHistory(TestCase):
+
+    def test_iter_objects_chunked(self):
+        rows = [dict(r, attributes={'friendly_name': 'Küche'})
+                for r in ROWS]
+        data = json.dumps([rows], ensure_ascii=False).encode()
+        # split inside objects and multi-byte characters
+        self.assertEqual(list(iter_objects(chunked(data, 7))), rows)
+
+    def test_iter_objects_truncated(self):
+        data = json.dumps([ROWS]).encode()[:-20]
+        with self.assertRaises(ValueError):
+            list(iter_objects(chunked(data, 16)))
+
+    def test_aggregates(self):
+        # START is 13:20 UTC
+        series = HistorySeries(START)
+        series.extend(ROWS)
+        end = START + 40 * 60
+        self.assertEqual(series.minimum(), 18.0)
+        self.assertEqual(series.maximum(), 22.0)
+        # 10 minutes each of 20, 22 and 18, unavailable is skipped
+        self.assertAlmostEqual(series.mean(end), 20.0)
+        # every state but unavailable counts as on
+        self.assertEqual(series.on_duration(end), 30 * 60)
+
+    def test_aggregates_without_numpy(self):
+        series = HistorySeries(START)
+        series.extend(ROWS)
+        end = START + 40 * 60
+        expected = (series.mean(end), series.on_duration(end),
+                    series.minimum(), series.maximum())
+        with mock.patch.object(history, 'np', None):
+            self.assertEqual((series.mean(end), series.on_duration(end),
+                              series.minimum(), series.maximum()),
+                             expected)
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time('2019-06-08T13:20:00+00:00'), START)
+        self.assertEqual(parse_time('2019-06-08T15:20:00.500000+02:00'),
+                         START + 0.5)
+        self.assertEqual(parse_time('2019-06-08T13:20:00Z'), START)
+
+    def test_several_days(self):
+        now = time()
+        with FakeHomeAssistant() as ha:
+            # one change a day over the last three days
+            ha.history['sensor.outside_temperature'] = [
+                {'state': str(10 + day),
+                 'last_changed': datetime.fromtimestamp(
+                     now - (3 - day) * DAY + 60, timezone.utc).isoformat()}
+                for day in range(3)]
+            client = HomeAssistantClient(ha.host, 'token', ha.port)
+            series = client.history('sensor.outside_temperature',
+                                    now - 3 * DAY)
+        # HA would stop a day after the start without an end_time
+        self.assertEqual(len(series), 3)
+        self.assertEqual(series.minimum(), 10.0)
+        self.assertEqual(series.maximum(), 12.0)
+
+    def test_cache_extends_incrementally(self):
+        fetch = mock.MagicMock(side_effect=[ROWS[:2], ROWS[1:]])
+        cache = HistoryCache(fetch)
+        series = cache.get('sensor.temperature', START)
+        self.assertIs(cache.get('sensor.temperature', START), series)
+        self.assertEqual(fetch.call_count, 1)
+
+        with mock.patch.object(history, 'HISTORY_TTL', -1):
+            cache.get('sensor.temperature', START)
+        # asked for the changes since the last known one only
+        self.assertEqual(fetch.call_args[0][1], START + 10 * 60)
+        self.assertEqual(series.maximum(), 22.0)
+        self.assertEqual(series.minimum(), 18.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+from unittest import TestCase
+import sys
+import unittest
+from os.path import dirname, join
+sys.path.append(join(dirname(__file__), '..'))
+from membership import MembershipIndex, expand_groups
+from ha_client import HomeAssistantClient
+from fake_ha import FakeHomeAssistant, light
+
+
+def group(name, members):
+    return {'entity_id': 'group.' + name.lower().replace(' ', '_'),
+            'state': 'on',
+            'attributes': {'friendly_name': name, 'entity_id': members}}
+
+
+STATES = [
+    light('Kitchen Ceiling', 'on'),
+    light('Kitchen Counter', 'off'),
+    light('Hall', 'on'),
+    {'entity_id': 'switch.kettle', 'state': 'on',
+     'attributes': {'friendly_name': 'Kettle'}},
+    group('Kitchen', ['light.kitchen_ceiling', 'light.kitchen_counter',
+                      'switch.kettle']),
+    group('Downstairs', ['group.kitchen', 'light.hall', 'group.downstairs'])
+]
+
+
+class TestMembershipIndex(TestCase):
+
+    def test_expand_nested_groups(self):
+        expanded = expand_groups({'group.a': ['group.b', 'light.x'],
+                                  'group.b': ['light.y', 'group.a']})
+        self.assertEqual(expanded['group.a'], {'light.x', 'light.y'})
+        self.assertEqual(expanded['group.b'], {'light.x', 'light.y'})
+
+    def test_counts(self):
+        index = MembershipIndex()
+        index.update(STATES)
+        kitchen = index.find('kitchen')
+        self.assertEqual(kitchen, 'group.kitchen')
+        self.assertEqual(index.active(kitchen), 2)
+        self.assertEqual(index.active(kitchen, 'light'), 1)
+        self.assertEqual(index.size(kitchen), 3)
+        self.assertEqual(index.active(index.find('downstairs')), 3)
+        self.assertEqual(index.active(domain='light'), 2)
+        self.assertIsNone(index.find('attic'))
+
+    def test_state_changes_adjust_counts(self):
+        index = MembershipIndex()
+        index.update(STATES)
+        index.apply([light('Kitchen Ceiling', 'off'),
+                     light('Kitchen Counter', 'on'),
+                     light('Garage', 'on')])
+        self.assertEqual(index.active('group.kitchen', 'light'), 1)
+        self.assertEqual(index.active(domain='light'), 3)
+        self.assertEqual(index.size(domain='light'), 4)
+        # a full update drops the entity HA doesn't know any more
+        index.update(STATES)
+        self.assertEqual(index.active(domain='light'), 2)
+        self.assertEqual(index.size(domain='light'), 3)
+
+    def test_areas(self):
+        index = MembershipIndex()
+        index.update(STATES)
+        index.set_areas({'Kitchen': ['light.kitchen_counter'],
+                         'Hallway': ['light.hall', 'group.kitchen']})
+        # the group wins over the area of the same name
+        self.assertEqual(index.find('kitchen'), 'group.kitchen')
+        hallway = index.find('hallway')
+        self.assertEqual(index.label(hallway), 'Hallway')
+        # misheard names match like entity names
+        self.assertEqual(index.find('the hall way'), hallway)
+        self.assertIsNone(index.find('garden'))
+        self.assertEqual(index.active(hallway), 3)
+        self.assertEqual(index.size(hallway), 4)
+
+
+class TestClientMembership(TestCase):
+
+    def test_areas_fetched_once(self):
+        with FakeHomeAssistant(STATES) as ha:
+            ha.areas = {'Hallway': ['light.hall']}
+            client = HomeAssistantClient(ha.host, ha.token, ha.port)
+            index = client.membership()
+            self.assertEqual(index.active(index.find('hallway')), 1)
+            client.execute_service('light', 'turn_off',
+                                   {'entity_id': 'light.hall'})
+            # the answer of the service call updated the counts
+            self.assertEqual(index.active(index.find('hallway')), 0)
+            client.membership()
+            self.assertEqual(ha.requests['POST', '/api/template'], 1)
+
+    def test_states_not_fetched_per_question(self):
+        with FakeHomeAssistant(STATES) as ha:
+            client = HomeAssistantClient(ha.host, ha.token, ha.port)
+            index = client.membership()
+            client.execute_service('light', 'turn_on',
+                                   {'entity_id': 'light.kitchen_counter'})
+            client.cache.invalidate()
+            self.assertEqual(client.membership().active(
+                index.find('kitchen')), 3)
+            self.assertEqual(ha.requests['GET', '/api/states'], 1)
+
+    def test_areas_listener(self):
+        with FakeHomeAssistant(STATES) as ha:
+            ha.areas = {'Hallway': ['light.hall']}
+            client = HomeAssistantClient(ha.host, ha.token, ha.port)
+            areas = []
+            client.areas_listener = areas.append
+            client.membership()
+            self.assertEqual(areas, [['Hallway']])
+
+    def test_without_areas(self):
+        with FakeHomeAssistant(STATES) as ha:
+            client = HomeAssistantClient(ha.host, ha.token, ha.port)
+            index = client.membership()
+            self.assertEqual(index.active(index.find('the kitchen')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+from unittest import TestCase
+import sys
+import unittest
+from os.path import dirname, join
+sys.path.append(join(dirname(__file__), '..'))
+import normalize as normalize_module
+from normalize import Normalizer, fold
+from state_cache import StateCache
+from ha_client import HomeAssistantClient
+from fake_ha import FakeHomeAssistant
+
+
+def state(entity_id, name):
+    return {'entity_id': entity_id, 'state': 'off',
+            'attributes': {'friendly_name': name}}
+
+
+class TestNormalizer(TestCase):
+
+    def test_fold(self):
+        self.assertEqual(fold('Café Straße'), 'cafe strasse')
+        self.assertEqual(fold('Küche', spell_umlauts=True), 'kueche')
+
+    def test_stopwords_and_order(self):
+        normalize = Normalizer('en-us')
+        self.assertEqual(normalize('the Outside Temperature'),
+                         normalize('temperature outside'))
+        # nothing but stopwords is still a name
+        self.assertEqual(normalize('Of The'), 'of the')
+
+    def test_trailing_letter_kept(self):
+        normalize = Normalizer('en-us')
+        self.assertNotEqual(normalize('Lamp A'), normalize('Lamp B'))
+        self.assertEqual(normalize('lamp a'), 'a lamp')
+        self.assertEqual(normalize('turn on a lamp'), 'lamp turn')
+
+    def test_compounds_split(self):
+        normalize = Normalizer('de-de')
+        normalize.learn(['Küche Decke', 'Wohnzimmer'])
+        self.assertEqual(normalize('das Küchenlicht'), 'kueche licht')
+        self.assertEqual(normalize('Küche Licht'), 'kueche licht')
+        self.assertEqual(normalize('Kuechenlicht'), 'kueche licht')
+        self.assertEqual(normalize('Wohnzimmerlampe'),
+                         normalize('Wohnzimmer Lampe'))
+
+    def test_split_consistent(self):
+        normalize = Normalizer('de-de')
+        normalize.learn(['wohnzimmer lampe', 'schlafzimmer licht'])
+        # known words are split like the same words inside a compound
+        self.assertEqual(normalize('Wohnzimmer Lampe'),
+                         normalize('Wohnzimmerlampe'))
+        self.assertEqual(normalize('Schlafzimmerlicht'),
+                         normalize('Schlafzimmer Licht'))
+        # unknown words stay as they are
+        self.assertEqual(normalize('Schreibtischlampe'),
+                         'schreibtischlampe')
+
+    def test_split_cache_bounded(self):
+        normalize = Normalizer('de-de')
+        for number in range(normalize_module.SPLIT_CACHE + 10):
+            normalize.split('kuechenlicht{}'.format(number))
+        self.assertEqual(normalize._splits.cache_info().currsize,
+                         normalize_module.SPLIT_CACHE)
+
+    def test_no_compounds_in_english(self):
+        normalize = Normalizer('en-us')
+        normalize.learn(['Bed', 'Room'])
+        self.assertEqual(normalize('bedroom'), 'bedroom')
+
+
+class TestNormalizedIndex(TestCase):
+
+    def test_forms_cached(self):
+        cache = StateCache(normalizer=Normalizer('de-de'))
+        cache.update([state('light.kuechenlicht', 'Küchenlicht'),
+                      state('light.flur', 'Flur Decke')])
+        forms = cache.forms('light.kuechenlicht', 'Küchenlicht')
+        self.assertEqual(forms, ('kueche licht', 'kueche licht light'))
+        self.assertIs(cache.forms('light.kuechenlicht'), forms)
+        # renaming an entity normalizes again
+        cache.update([state('light.kuechenlicht', 'Küchenlampe')])
+        self.assertEqual(cache.forms('light.kuechenlicht', 'Küchenlampe'),
+                         ('kueche lampe', 'kueche licht light'))
+
+    def test_find_entity(self):
+        states = [state('light.kuechenlicht', 'Küchenlicht'),
+                  state('light.kuechendecke', 'Küche Decke'),
+                  state('light.wohnzimmer', 'Wohnzimmer Lampe')]
+        with FakeHomeAssistant(states) as ha:
+            client = HomeAssistantClient(ha.host, ha.token, ha.port,
+                                         lang='de-de')
+            entity = client.find_entity('das küche licht', ['light'])
+            self.assertEqual(entity['id'], 'light.kuechenlicht')
+            self.assertEqual(entity['best_score'], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+from unittest import TestCase
+import os
+import pstats
+import sys
+import tempfile
+import unittest
+from os.path import dirname, join
+sys.path.append(join(dirname(__file__), '..'))
+import profiler
+from profiler import HandlerProfiler
+
+
+def handle_intent(message):
+    return sum(range(1000)) + message
+
+
+class TestProfiler(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_aggregated_per_handler(self):
+        handlers = HandlerProfiler(self.directory.name, 1)
+        for _ in range(3):
+            self.assertEqual(handlers.run('handle_intent', handle_intent, 1),
+                             499501)
+        stats = pstats.Stats(join(self.directory.name, 'handle_intent.prof'))
+        calls = [value[1] for key, value in stats.stats.items()
+                 if key[2] == 'handle_intent']
+        self.assertEqual(calls, [3])
+
+    def test_files_rotated(self):
+        handlers = HandlerProfiler(self.directory.name, 1)
+        for _ in range(profiler.SAMPLES_PER_FILE * 2 + 1):
+            handlers.run('handle_intent', handle_intent, 1)
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         ['handle_intent.prof', 'handle_intent.prof.1',
+                          'handle_intent.prof.2'])
+
+    def test_not_sampled(self):
+        handlers = HandlerProfiler(self.directory.name, 0)
+        handlers.run('handle_intent', handle_intent, 1)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_exception_passed(self):
+        handlers = HandlerProfiler(self.directory.name, 1)
+        with self.assertRaises(TypeError):
+            handlers.run('handle_intent', handle_intent, None)
+        self.assertTrue(os.path.exists(
+            join(self.directory.name, 'handle_intent.prof')))
+
+
+if __name__ == '__main__':
+    unittest.main()
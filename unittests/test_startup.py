@@ -0,0 +1,89 @@
+"""Startup benchmark: import time of the client and skill load time
+
+Run directly to print the measurements:
+    python unittests/test_startup.py -v
+"""
+from unittest import TestCase
+import subprocess
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from os.path import dirname, join
+from time import perf_counter
+from unittest import mock
+sys.path.append(join(dirname(__file__), '..'))
+from test_concurrency import load_skill
+from lazy import lazy_import
+
+ROOT = join(dirname(__file__), '..')
+
+# Regression thresholds in milliseconds, about three times the times
+# measured on a desktop to leave room for slow CI machines and a Pi
+IMPORT_BUDGET = 400
+LOAD_BUDGET = 1000
+
+# Modules that must only be loaded once a handler needs them
+LAZY_MODULES = ('numpy', 'fuzzywuzzy.fuzz')
+
+
+def import_times(module):
+    """Cumulative import times in ms per module, from -X importtime"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True,
+        check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        try:
+            _, cumulative, name = line.split('|')
+            times[name.strip()] = int(cumulative) / 1000
+        except ValueError:
+            # the header line
+            continue
+    return times
+
+
+class TestStartup(TestCase):
+
+    def test_lazy_modules_not_imported(self):
+        # lazy modules are registered, but never executed
+        times = import_times('ha_client')
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, times)
+
+    def test_concurrent_first_access(self):
+        sys.modules.pop('xml.dom.minidom', None)
+        module = lazy_import('xml.dom.minidom')
+        with ThreadPoolExecutor(16) as pool:
+            results = list(pool.map(lambda _: module.parseString,
+                                    range(64)))
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertIsNone(lazy_import('no_such_module_here'))
+
+    def test_import_time(self):
+        # best of three, the first run may fill the bytecode cache
+        milliseconds = min(import_times('ha_client')['ha_client']
+                           for _ in range(3))
+        print('import ha_client: {:.1f} ms'.format(milliseconds))
+        self.assertLess(milliseconds, IMPORT_BUDGET)
+
+    def test_skill_load_time(self):
+        try:
+            module = load_skill()
+        except ImportError as e:
+            self.skipTest('mycroft-core not available: {}'.format(e))
+        start = perf_counter()
+        skill = module.create_skill()
+        skill.bind(mock.MagicMock())
+        skill.settings = {}
+        with mock.patch.object(module, 'Thread'):
+            skill.initialize()
+        milliseconds = (perf_counter() - start) * 1000
+        print('create_skill + initialize: {:.1f} ms'.format(milliseconds))
+        self.assertLess(milliseconds, LOAD_BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main()
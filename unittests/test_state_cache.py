@@ -0,0 +1,143 @@
+from unittest import TestCase
+import gc
+import sys
+import tracemalloc
+import unittest
+from os.path import dirname, join
+sys.path.append(join(dirname(__file__), '..'))
+from state_cache import StateCache, prune_state
+from ha_client import HomeAssistantClient
+from fake_ha import FakeHomeAssistant
+
+
+def make_states(count):
+    """Build a state dump with bulky attributes, like a real HA server"""
+    states = []
+    for i in range(count):
+        domain = ('light', 'sensor', 'media_player', 'switch')[i % 4]
+        states.append({
+            'entity_id': '{}.entity_{}'.format(domain, i),
+            'state': 'on',
+            'last_changed': '2019-06-01T12:00:00.000000+00:00',
+            'context': {'id': 'x' * 32, 'parent_id': None},
+            'attributes': {
+                'friendly_name': 'Entity number {}'.format(i),
+                'brightness': i % 255,
+                'unit_of_measurement': '°C',
+                'supported_features': 151,
+                'effect_list': ['effect {}'.format(n) for n in range(20)],
+                'entity_picture': '/api/image/{}'.format('y' * 64)
+            }
+        })
+    return states
+
+
+class TestStateCache(TestCase):
+
+    def test_prune_state(self):
+        state = make_states(1)[0]
+        self.assertEqual(prune_state(state), {
+            'entity_id': 'light.entity_0',
+            'state': 'on',
+            'attributes': {'friendly_name': 'Entity number 0',
+                           'brightness': 0,
+                           'unit_of_measurement': '°C'}})
+        self.assertIsNone(prune_state({'entity_id': 'media_player.tv'}))
+
+    def test_irrelevant_domains_dropped(self):
+        cache = StateCache()
+        states = cache.update(make_states(8))
+        self.assertEqual(len(states), 6)
+        self.assertNotIn('media_player', cache.domains())
+
+    def test_budget_evicts_least_recently_queried(self):
+        cache = StateCache(budget=128 * 1024)
+        cache.touch(['sensor'])
+        cache.update(make_states(400))
+        self.assertLessEqual(cache.size(), 128 * 1024)
+        self.assertIn('sensor', cache.domains())
+        self.assertFalse(cache.is_fresh(['light']))
+
+    def test_resize(self):
+        cache = StateCache()
+        cache.update(make_states(400))
+        self.assertEqual(len(cache.domains()), 3)
+        cache.resize(128 * 1024)
+        self.assertEqual(len(cache.domains()), 1)
+
+    def test_idle_domains_evicted(self):
+        cache = StateCache(idle=-1)
+        cache.update(make_states(8))
+        self.assertEqual(cache.domains(), [])
+
+    def test_name_lookup(self):
+        cache = StateCache()
+        cache.update(make_states(8))
+        self.assertEqual(cache.lookup('Entity Number 4', ['light']),
+                         'light.entity_4')
+        self.assertEqual(cache.lookup('light.entity_4', ['light']),
+                         'light.entity_4')
+        self.assertIsNone(cache.lookup('entity number 4', ['sensor']))
+        self.assertNotIn('entity number 2', cache.names())
+
+    def test_names_version(self):
+        cache = StateCache()
+        cache.update(make_states(8))
+        version = cache.names_version
+        cache.update(make_states(8))
+        self.assertEqual(cache.names_version, version)
+        cache.update(make_states(9))
+        self.assertEqual(cache.names_version, version + 1)
+
+    def test_memory_budget(self):
+        budget = 256 * 1024
+        cache = StateCache(budget=budget)
+        cache.touch(['sensor'])
+        gc.collect()
+        tracemalloc.start()
+        try:
+            baseline = tracemalloc.get_traced_memory()[0]
+            for _ in range(3):
+                states = make_states(800)
+                cache.update(states)
+                del states
+            gc.collect()
+            self.assertEqual(cache.domains(), ['sensor'])
+            retained = tracemalloc.get_traced_memory()[0] - baseline
+        finally:
+            tracemalloc.stop()
+        self.assertLessEqual(retained, budget)
+
+
+def classified(entity_id, name, state, device_class, unit=None):
+    attributes = {'friendly_name': name, 'device_class': device_class}
+    if unit:
+        attributes['unit_of_measurement'] = unit
+    return {'entity_id': entity_id, 'state': state, 'attributes': attributes}
+
+
+class TestSummary(TestCase):
+
+    def test_summary_from_one_snapshot(self):
+        states = [
+            classified('sensor.kitchen', 'Kitchen', '21.5',
+                       'temperature', '°C'),
+            classified('sensor.attic', 'Attic', '14', 'temperature', '°C'),
+            classified('sensor.kitchen_rh', 'Kitchen', '40',
+                       'humidity', '%'),
+            classified('binary_sensor.door', 'Door', 'on', 'door'),
+            classified('binary_sensor.window', 'Window', 'off', 'window')]
+        with FakeHomeAssistant(states) as ha:
+            client = HomeAssistantClient(ha.host, ha.token, ha.port)
+            temperatures = client.summary('sensor', 'temperature')
+            windows = client.summary('binary_sensor', 'window')
+            self.assertEqual(sum(ha.requests.values()), 1)
+        self.assertEqual([(t['name'], t['state'], t['unit'])
+                          for t in temperatures],
+                         [('Attic', '14', '°C'), ('Kitchen', '21.5', '°C')])
+        self.assertEqual([w['id'] for w in windows],
+                         ['binary_sensor.window'])
+
+
+if __name__ == '__main__':
+    unittest.main()